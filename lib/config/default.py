@@ -9,10 +9,13 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import copy
 import os
 
 from yacs.config import CfgNode as CN
 
+from .models import MODEL_EXTRAS
+
 
 _C = CN()
 
@@ -24,7 +27,12 @@ _C.WORKERS = 4
 _C.PRINT_FREQ = 20
 _C.AUTO_RESUME = False
 _C.PIN_MEMORY = True
+# set from the environment by utils.distributed.init_distributed
 _C.RANK = 0
+# nccl with cuda and gloo without when empty
+_C.DIST_BACKEND = ''
+# seeds the weights, the sample order and the augmentation, random if < 0
+_C.SEED = -1
 
 # Cudnn related params
 _C.CUDNN = CN()
@@ -32,6 +40,14 @@ _C.CUDNN.BENCHMARK = True
 _C.CUDNN.DETERMINISTIC = False
 _C.CUDNN.ENABLED = True
 
+# torch.compile of the model in train.py, test.py and demo.py
+_C.COMPILE = CN()
+_C.COMPILE.ENABLED = False
+_C.COMPILE.MODE = 'default'
+_C.COMPILE.BACKEND = 'inductor'
+# log graph breaks and eager vs compiled forward time
+_C.COMPILE.AUDIT = False
+
 # common params for NETWORK
 _C.MODEL = CN()
 _C.MODEL.NAME = 'pose_hrnet'
@@ -46,6 +62,9 @@ _C.MODEL.SIGMA = 2
 _C.MODEL.EXTRA = CN(new_allowed=True)
 
 _C.LOSS = CN()
+# one of core.loss.LOSSES (mse, ohkm_mse, fused_mse), empty picks mse or
+# ohkm_mse from USE_OHKM
+_C.LOSS.NAME = ''
 _C.LOSS.USE_OHKM = False
 _C.LOSS.TOPK = 8
 _C.LOSS.USE_TARGET_WEIGHT = True
@@ -60,6 +79,8 @@ _C.DATASET.TEST_SET = 'valid'
 _C.DATASET.DATA_FORMAT = 'jpg'
 _C.DATASET.HYBRID_JOINTS_TYPE = ''
 _C.DATASET.SELECT_DATA = False
+# pickled annotations and sample db shared by runs on the same data
+_C.DATASET.CACHE_DIR = ''
 
 # training data augmentation
 _C.DATASET.FLIP = True
@@ -98,6 +119,24 @@ _C.TRAIN.CHECKPOINT = ''
 
 _C.TRAIN.BATCH_SIZE_PER_GPU = 32
 _C.TRAIN.SHUFFLE = True
+# mixed precision training: fp32, fp16 (with loss scaling) or bf16,
+# cuda only
+_C.TRAIN.PRECISION = 'fp32'
+# batches whose gradients are accumulated for every optimizer step
+_C.TRAIN.ACCUM_STEPS = 1
+# LR is for this total batch size (BATCH_SIZE_PER_GPU x GPUS x ACCUM_STEPS)
+# and scaled linearly to the actual one, 0 keeps LR as it is
+_C.TRAIN.BASE_BATCH_SIZE = 0
+# also save checkpoint.pth within an epoch, every CHECKPOINT_STEPS optimizer
+# steps and every CHECKPOINT_SECS seconds (checked every PRINT_FREQ steps),
+# 0 disables either
+_C.TRAIN.CHECKPOINT_STEPS = 0
+_C.TRAIN.CHECKPOINT_SECS = 0
+# write the checkpoints from a background thread
+_C.TRAIN.ASYNC_CHECKPOINT = False
+# keep the last ones as checkpoint_e<epoch>_i<iteration>.pth, 0 only keeps
+# checkpoint.pth
+_C.TRAIN.KEEP_LAST_CHECKPOINTS = 0
 
 # testing
 _C.TEST = CN()
@@ -120,6 +159,34 @@ _C.TEST.IN_VIS_THRE = 0.0
 _C.TEST.COCO_BBOX_FILE = ''
 _C.TEST.BBOX_THRE = 1.0
 _C.TEST.MODEL_FILE = ''
+# write keypoints_*_results_*.json besides evaluating in memory
+_C.TEST.SAVE_RESULTS = True
+# vectorized OKS evaluator (core/coco_eval_fast.py) instead of pycocotools
+_C.TEST.FAST_COCO_EVAL = False
+# process pool of the coco rescoring / oks nms and of the fast evaluator
+_C.TEST.EVAL_WORKERS = 0
+# train.py: evaluate in a background process while the next epoch trains
+_C.TEST.ASYNC_EVAL = False
+# inference mode: fp32, fp16 or bf16 autocast (cuda only) and NHWC layout
+_C.TEST.PRECISION = 'fp32'
+_C.TEST.CHANNELS_LAST = False
+# fold BatchNorm into the convs before inference (utils/fusion.py)
+_C.TEST.FUSE_BN = False
+# .pt / .onnx file from tools/export.py, used instead of MODEL.NAME
+_C.TEST.EXPORTED_MODEL = ''
+
+# heatmap distillation from a frozen teacher in train.py
+_C.DISTILL = CN()
+_C.DISTILL.ENABLED = False
+# teacher experiment file, merged over this config
+_C.DISTILL.TEACHER_CFG = ''
+_C.DISTILL.TEACHER_MODEL_FILE = ''
+# loss = gt loss + WEIGHT * loss against the teacher heatmaps
+_C.DISTILL.WEIGHT = 1.0
+# teacher autocast: fp32, fp16 or bf16
+_C.DISTILL.PRECISION = 'fp32'
+# cache the teacher heatmaps here, only used with fixed augmentation
+_C.DISTILL.CACHE_DIR = ''
 
 # debug
 _C.DEBUG = CN()
@@ -128,11 +195,29 @@ _C.DEBUG.SAVE_BATCH_IMAGES_GT = False
 _C.DEBUG.SAVE_BATCH_IMAGES_PRED = False
 _C.DEBUG.SAVE_HEATMAPS_GT = False
 _C.DEBUG.SAVE_HEATMAPS_PRED = False
+# opt in: render and write the debug images on a worker thread, dropping
+# frames when WRITER_QUEUE_SIZE jobs are already waiting
+_C.DEBUG.ASYNC_WRITER = False
+_C.DEBUG.WRITER_QUEUE_SIZE = 4
+
+
+def add_model_extras(cfg):
+    '''
+    add the defaults of config.models for the MODEL.EXTRA keys the
+    experiment file leaves out, so they can be set from the command line
+    '''
+    extras = MODEL_EXTRAS.get(cfg.MODEL.NAME)
+    if extras is None:
+        return
+    for key, value in extras.items():
+        if key not in cfg.MODEL.EXTRA:
+            cfg.MODEL.EXTRA[key] = copy.deepcopy(value)
 
 
 def update_config(cfg, args):
     cfg.defrost()
     cfg.merge_from_file(args.cfg)
+    add_model_extras(cfg)
     cfg.merge_from_list(args.opts)
 
     if args.modelDir:
@@ -157,6 +242,11 @@ def update_config(cfg, args):
             cfg.DATA_DIR, cfg.TEST.MODEL_FILE
         )
 
+    if cfg.TEST.EXPORTED_MODEL:
+        cfg.TEST.EXPORTED_MODEL = os.path.join(
+            cfg.DATA_DIR, cfg.TEST.EXPORTED_MODEL
+        )
+
     cfg.freeze()
 
 
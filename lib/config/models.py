@@ -26,6 +26,11 @@ POSE_HIGH_RESOLUTION_NET = CN()
 POSE_HIGH_RESOLUTION_NET.PRETRAINED_LAYERS = ['*']
 POSE_HIGH_RESOLUTION_NET.STEM_INPLANES = 64
 POSE_HIGH_RESOLUTION_NET.FINAL_CONV_KERNEL = 1
+# exchange units add the nearest upsampled low resolution maps in place
+# instead of materializing them
+POSE_HIGH_RESOLUTION_NET.INPLACE_FUSE = False
+# activation checkpointing of the stages: '', 'module' or 'branch'
+POSE_HIGH_RESOLUTION_NET.CHECKPOINT = ''
 
 POSE_HIGH_RESOLUTION_NET.STAGE2 = CN()
 POSE_HIGH_RESOLUTION_NET.STAGE2.NUM_MODULES = 1
@@ -55,4 +60,5 @@ POSE_HIGH_RESOLUTION_NET.STAGE4.FUSE_METHOD = 'SUM'
 MODEL_EXTRAS = {
     'pose_resnet': POSE_RESNET,
     'pose_high_resolution_net': POSE_HIGH_RESOLUTION_NET,
+    'pose_hrnet': POSE_HIGH_RESOLUTION_NET,
 }
@@ -0,0 +1,95 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import multiprocessing
+
+
+logger = logging.getLogger(__name__)
+
+_worker_state = {}
+
+
+def _get_log_file():
+    '''the file the trainer logs to, see utils.utils.create_logger'''
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.FileHandler):
+            return handler.baseFilename
+    return None
+
+
+def _init_worker(config, val_dataset, log_file):
+    # a spawned worker starts without the logging setup of the trainer
+    head = '%(asctime)-15s %(message)s'
+    logging.basicConfig(filename=log_file, format=head)
+    logging.getLogger().setLevel(logging.INFO)
+    _worker_state['config'] = config
+    _worker_state['val_dataset'] = val_dataset
+
+
+def _evaluate(output_dir, preds, all_boxes, img_path, filenames, imgnums):
+    config = _worker_state['config']
+    val_dataset = _worker_state['val_dataset']
+    name_values, perf_indicator = val_dataset.evaluate(
+        config, preds, output_dir, all_boxes, img_path,
+        filenames, imgnums
+    )
+    if hasattr(val_dataset, 'wait_for_results_writer'):
+        val_dataset.wait_for_results_writer()
+    return name_values, perf_indicator
+
+
+class AsyncEvaluator(object):
+    """
+    Runs val_dataset.evaluate (rescoring, oks nms, result writing and
+    cocoeval) in a background process, so the next epoch can start
+    while the previous one is evaluated. The worker logs to the log file
+    of the trainer.
+    """
+    def __init__(self, config, val_dataset, output_dir):
+        self.output_dir = output_dir
+        # spawn instead of fork, the trainer has dataloader and cuda
+        # threads running when the worker is started
+        self.executor = ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(config, val_dataset, _get_log_file())
+        )
+        self.pending = []
+
+    def submit(self, preds, all_boxes, img_path, filenames=None,
+               imgnums=None, tag=None):
+        future = self.executor.submit(
+            _evaluate, self.output_dir, preds, all_boxes, img_path,
+            filenames, imgnums
+        )
+        self.pending.append((tag, future))
+
+    def collect(self, wait=False):
+        """
+        :param wait: block until every submitted evaluation is done
+        :return: [(tag, name_values, perf_indicator)] of the finished
+                 evaluations, in submission order
+        """
+        finished = []
+        while self.pending:
+            tag, future = self.pending[0]
+            if not wait and not future.done():
+                break
+            self.pending.pop(0)
+            name_values, perf_indicator = future.result()
+            finished.append((tag, name_values, perf_indicator))
+        return finished
+
+    def close(self):
+        finished = self.collect(wait=True)
+        self.executor.shutdown()
+        return finished
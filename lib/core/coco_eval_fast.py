@@ -0,0 +1,426 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from collections import defaultdict
+import logging
+import multiprocessing
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+# parameters of pycocotools COCOeval for iouType='keypoints'
+KPT_OKS_SIGMAS = np.array([
+    .26, .25, .25, .35, .35, .79, .79, .72, .72,
+    .62, .62, 1.07, 1.07, .87, .87, .89, .89
+]) / 10.0
+IOU_THRS = np.linspace(
+    .5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True
+)
+REC_THRS = np.linspace(
+    .0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True
+)
+AREA_RNGS = [[0 ** 2, 1e5 ** 2], [32 ** 2, 96 ** 2], [96 ** 2, 1e5 ** 2]]
+AREA_RNG_LBLS = ['all', 'medium', 'large']
+MAX_DETS = 20
+
+STATS_NAMES = [
+    'AP', 'Ap .5', 'AP .75', 'AP (M)', 'AP (L)',
+    'AR', 'AR .5', 'AR .75', 'AR (M)', 'AR (L)'
+]
+
+
+def _gt_arrays(anns):
+    kpts = np.array(
+        [ann['keypoints'] for ann in anns], dtype=np.float64
+    ).reshape((len(anns), len(KPT_OKS_SIGMAS), 3))
+    iscrowd = np.array(
+        [bool(ann.get('iscrowd', 0)) for ann in anns], dtype=bool
+    )
+    num_kpts = np.array([ann['num_keypoints'] for ann in anns])
+    return {
+        'keypoints': kpts,
+        'area': np.array([ann['area'] for ann in anns], dtype=np.float64),
+        'bbox': np.array(
+            [ann['bbox'] for ann in anns], dtype=np.float64
+        ).reshape((len(anns), 4)),
+        'iscrowd': iscrowd,
+        # same as COCOeval._prepare for keypoints
+        'ignore': np.logical_or(iscrowd, num_kpts == 0),
+    }
+
+
+def _dt_arrays(results):
+    kpts = np.array(
+        [res['keypoints'] for res in results], dtype=np.float64
+    ).reshape((len(results), len(KPT_OKS_SIGMAS), 3))
+    # same as COCO.loadRes: area of the keypoints' bounding box
+    if len(results) > 0:
+        area = (kpts[:, :, 0].max(1) - kpts[:, :, 0].min(1)) * \
+            (kpts[:, :, 1].max(1) - kpts[:, :, 1].min(1))
+    else:
+        area = np.zeros((0,))
+    return {
+        'keypoints': kpts,
+        'area': area,
+        'score': np.array(
+            [res['score'] for res in results], dtype=np.float64
+        ),
+    }
+
+
+def compute_oks(gt, dt):
+    '''
+    OKS between every detection and every ground truth of one image,
+    vectorized version of COCOeval.computeOks
+    :return: [num_dets, num_gts]
+    '''
+    vars = (KPT_OKS_SIGMAS * 2) ** 2
+
+    xg = gt['keypoints'][None, :, :, 0]
+    yg = gt['keypoints'][None, :, :, 1]
+    vg = gt['keypoints'][None, :, :, 2]
+    xd = dt['keypoints'][:, None, :, 0]
+    yd = dt['keypoints'][:, None, :, 1]
+
+    # ground truths without labeled keypoints are compared against
+    # their enlarged bounding box instead
+    has_kpts = (np.count_nonzero(vg > 0, axis=2) > 0)[:, :, None]
+    bb = gt['bbox']
+    x0 = (bb[:, 0] - bb[:, 2])[None, :, None]
+    x1 = (bb[:, 0] + bb[:, 2] * 2)[None, :, None]
+    y0 = (bb[:, 1] - bb[:, 3])[None, :, None]
+    y1 = (bb[:, 1] + bb[:, 3] * 2)[None, :, None]
+
+    dx = np.where(
+        has_kpts, xd - xg,
+        np.maximum(0, x0 - xd) + np.maximum(0, xd - x1)
+    )
+    dy = np.where(
+        has_kpts, yd - yg,
+        np.maximum(0, y0 - yd) + np.maximum(0, yd - y1)
+    )
+    e = (dx ** 2 + dy ** 2) / vars / \
+        (gt['area'][None, :, None] + np.spacing(1)) / 2
+
+    valid = np.logical_or(np.logical_not(has_kpts), vg > 0)
+    valid = np.broadcast_to(valid, e.shape)
+    return np.sum(np.exp(-e) * valid, axis=2) / np.sum(valid, axis=2)
+
+
+def _last_argmax(values, mask):
+    '''
+    index of the last maximum of values[t][mask[t]] for every row t,
+    which is the match pycocotools' greedy loop ends up with
+    '''
+    num_gts = values.shape[1]
+    masked = np.where(mask, values, -np.inf)[:, ::-1]
+    return num_gts - 1 - np.argmax(masked, axis=1), mask.any(axis=1)
+
+
+def _match(ious, gt_ignore, gt_crowd):
+    num_thrs = len(IOU_THRS)
+    num_dets, num_gts = ious.shape
+    thrs = np.minimum(IOU_THRS, 1 - 1e-10)[:, None]
+
+    gt_matched = np.zeros((num_thrs, num_gts), dtype=bool)
+    dt_matched = np.zeros((num_thrs, num_dets), dtype=bool)
+    dt_ignore = np.zeros((num_thrs, num_dets), dtype=bool)
+    if num_dets == 0 or num_gts == 0:
+        return dt_matched, dt_ignore
+
+    # all thresholds are matched at once, detections in score order
+    for d in range(num_dets):
+        iou = np.broadcast_to(ious[d], (num_thrs, num_gts))
+        candidate = np.logical_and(
+            np.logical_or(np.logical_not(gt_matched), gt_crowd),
+            iou >= thrs
+        )
+        # a ground truth that is not ignored is always preferred
+        m, found = _last_argmax(
+            iou, np.logical_and(candidate, np.logical_not(gt_ignore))
+        )
+        m_ig, found_ig = _last_argmax(
+            iou, np.logical_and(candidate, gt_ignore)
+        )
+        m = np.where(found, m, m_ig)
+        t = np.nonzero(np.logical_or(found, found_ig))[0]
+
+        dt_matched[t, d] = True
+        dt_ignore[t, d] = gt_ignore[m[t]]
+        gt_matched[t, m[t]] = True
+
+    return dt_matched, dt_ignore
+
+
+def evaluate_image(gt, dt):
+    '''
+    match the detections of one image for every area range,
+    vectorized version of COCOeval.evaluateImg
+    :return: None if the image has neither gts nor dts, else one
+             (dt_scores, dt_matched, dt_ignore, gt_ignore) per area range
+    '''
+    if len(gt['area']) == 0 and len(dt['area']) == 0:
+        return None
+
+    order = np.argsort(-dt['score'], kind='mergesort')[:MAX_DETS]
+    dt = {k: v[order] for k, v in dt.items()}
+
+    if len(gt['area']) > 0 and len(dt['area']) > 0:
+        ious = compute_oks(gt, dt)
+    else:
+        ious = np.zeros((len(dt['area']), len(gt['area'])))
+
+    evals = []
+    for area_rng in AREA_RNGS:
+        gt_ignore = np.logical_or(
+            gt['ignore'],
+            np.logical_or(gt['area'] < area_rng[0],
+                          gt['area'] > area_rng[1])
+        )
+        gtind = np.argsort(gt_ignore, kind='mergesort')
+        gt_ignore = gt_ignore[gtind]
+
+        dt_matched, dt_ignore = _match(
+            ious[:, gtind], gt_ignore, gt['iscrowd'][gtind]
+        )
+
+        dt_out = np.logical_or(dt['area'] < area_rng[0],
+                               dt['area'] > area_rng[1])
+        dt_ignore = np.logical_or(
+            dt_ignore,
+            np.logical_and(np.logical_not(dt_matched), dt_out[None, :])
+        )
+        evals.append((dt['score'], dt_matched, dt_ignore, gt_ignore))
+
+    return evals
+
+
+def _evaluate_images(items):
+    return [evaluate_image(gt, dt) for gt, dt in items]
+
+
+def accumulate(evals):
+    '''
+    vectorized version of COCOeval.accumulate for a single category
+    :param evals: evaluate_image() outputs of all images, None removed
+    :return: precision [T, R, A], recall [T, A]
+    '''
+    num_thrs = len(IOU_THRS)
+    num_areas = len(AREA_RNGS)
+    precision = -np.ones((num_thrs, len(REC_THRS), num_areas))
+    recall = -np.ones((num_thrs, num_areas))
+
+    for a in range(num_areas):
+        E = [e[a] for e in evals]
+        if len(E) == 0:
+            continue
+
+        dt_scores = np.concatenate([e[0] for e in E])
+        inds = np.argsort(-dt_scores, kind='mergesort')
+        dt_matched = np.concatenate([e[1] for e in E], axis=1)[:, inds]
+        dt_ignore = np.concatenate([e[2] for e in E], axis=1)[:, inds]
+        gt_ignore = np.concatenate([e[3] for e in E])
+
+        npig = np.count_nonzero(np.logical_not(gt_ignore))
+        if npig == 0:
+            continue
+
+        tps = np.logical_and(dt_matched, np.logical_not(dt_ignore))
+        fps = np.logical_and(np.logical_not(dt_matched),
+                             np.logical_not(dt_ignore))
+        tp_sum = np.cumsum(tps, axis=1).astype(np.float64)
+        fp_sum = np.cumsum(fps, axis=1).astype(np.float64)
+
+        nd = tp_sum.shape[1]
+        if nd == 0:
+            recall[:, a] = 0
+            precision[:, :, a] = 0
+            continue
+
+        rc = tp_sum / npig
+        pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+        recall[:, a] = rc[:, -1]
+
+        # make precision monotonically decreasing
+        pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+
+        for t in range(num_thrs):
+            pi = np.searchsorted(rc[t], REC_THRS, side='left')
+            precision[t, :, a] = np.where(
+                pi < nd, pr[t, np.minimum(pi, nd - 1)], 0
+            )
+
+    return precision, recall
+
+
+def summarize(precision, recall):
+    '''
+    the 10 keypoint numbers printed by COCOeval.summarize
+    :param precision: [T, R, K, A]
+    :param recall: [T, K, A]
+    '''
+    def _summarize(ap=1, iou_thr=None, area_rng='all'):
+        aind = AREA_RNG_LBLS.index(area_rng)
+        s = precision[..., aind] if ap == 1 else recall[..., aind]
+        if iou_thr is not None:
+            s = s[np.isclose(IOU_THRS, iou_thr)]
+        s = s[s > -1]
+        return np.mean(s) if len(s) > 0 else -1
+
+    stats = np.zeros((10,))
+    stats[0] = _summarize(1)
+    stats[1] = _summarize(1, iou_thr=.5)
+    stats[2] = _summarize(1, iou_thr=.75)
+    stats[3] = _summarize(1, area_rng='medium')
+    stats[4] = _summarize(1, area_rng='large')
+    stats[5] = _summarize(0)
+    stats[6] = _summarize(0, iou_thr=.5)
+    stats[7] = _summarize(0, iou_thr=.75)
+    stats[8] = _summarize(0, area_rng='medium')
+    stats[9] = _summarize(0, area_rng='large')
+    return stats
+
+
+def evaluate_keypoints(coco_gt, results, num_workers=0):
+    '''
+    OKS AP/AR of keypoint results, drop-in for COCOeval(..., 'keypoints')
+    with evaluate(), accumulate() and summarize()
+    :param coco_gt: pycocotools COCO of the ground truth
+    :param results: list of result dicts (image_id, category_id,
+                    keypoints, score), as passed to COCO.loadRes
+    :param num_workers: shard the images over a process pool if > 0
+    :return: the 10 stats of COCOeval.summarize
+    '''
+    img_ids = sorted(coco_gt.getImgIds())
+    cat_ids = sorted(coco_gt.getCatIds())
+    img_set = set(img_ids)
+
+    dts = defaultdict(list)
+    for res in results:
+        if res['image_id'] in img_set:
+            dts[res['image_id'], res['category_id']].append(res)
+
+    items = []
+    for cat_id in cat_ids:
+        for img_id in img_ids:
+            gts = [
+                ann for ann in coco_gt.imgToAnns.get(img_id, [])
+                if ann['category_id'] == cat_id
+            ]
+            items.append(
+                (_gt_arrays(gts), _dt_arrays(dts[img_id, cat_id]))
+            )
+
+    if num_workers > 0 and multiprocessing.current_process().daemon:
+        # daemonic processes (e.g. pool workers) may not have children
+        num_workers = 0
+
+    if num_workers > 0:
+        chunk = int(np.ceil(len(items) / float(num_workers)))
+        shards = [items[i:i + chunk] for i in range(0, len(items), chunk)]
+        with multiprocessing.Pool(num_workers) as pool:
+            evals = sum(pool.map(_evaluate_images, shards), [])
+    else:
+        evals = _evaluate_images(items)
+
+    precision = []
+    recall = []
+    for k in range(len(cat_ids)):
+        cat_evals = evals[k * len(img_ids):(k + 1) * len(img_ids)]
+        p, r = accumulate([e for e in cat_evals if e is not None])
+        precision.append(p)
+        recall.append(r)
+
+    stats = summarize(np.stack(precision, axis=2), np.stack(recall, axis=1))
+    for name, value in zip(STATS_NAMES, stats):
+        logger.info('=> {}: {:.3f}'.format(name, value))
+
+    return stats
+
+
+def _synthetic_coco(num_images=60, seed=0):
+    from pycocotools.coco import COCO
+
+    rng = np.random.RandomState(seed)
+    images = []
+    annotations = []
+    results = []
+    for img_id in range(1, num_images + 1):
+        images.append({'id': img_id, 'width': 640, 'height': 480})
+        for _ in range(rng.randint(0, 5)):
+            x, y = rng.uniform(0, 400, 2)
+            w, h = rng.uniform(10, 200, 2)
+            kpts = np.zeros((17, 3))
+            kpts[:, 0] = x + rng.uniform(0, w, 17)
+            kpts[:, 1] = y + rng.uniform(0, h, 17)
+            kpts[:, 2] = rng.choice([0, 1, 2], 17, p=[.3, .2, .5])
+            if rng.rand() < .1:
+                kpts[:, 2] = 0
+            kpts[kpts[:, 2] == 0, :2] = 0
+            annotations.append({
+                'id': len(annotations) + 1,
+                'image_id': img_id,
+                'category_id': 1,
+                'bbox': [x, y, w, h],
+                'area': w * h * rng.uniform(.5, 1.),
+                'iscrowd': int(rng.rand() < .05),
+                'num_keypoints': int(np.count_nonzero(kpts[:, 2])),
+                'keypoints': kpts.reshape(-1).tolist(),
+            })
+            for _ in range(rng.randint(0, 3)):
+                det = np.zeros((17, 3))
+                det[:, 0] = x + rng.uniform(0, w, 17) + \
+                    rng.normal(0, 5, 17)
+                det[:, 1] = y + rng.uniform(0, h, 17) + \
+                    rng.normal(0, 5, 17)
+                det[:, 2] = rng.rand(17)
+                near = annotations[-1]['keypoints']
+                if rng.rand() < .7:
+                    det[:, :2] = np.array(near).reshape(17, 3)[:, :2] + \
+                        rng.normal(0, rng.uniform(.5, 10), (17, 2))
+                results.append({
+                    'image_id': img_id,
+                    'category_id': 1,
+                    'keypoints': det.reshape(-1).tolist(),
+                    'score': float(np.round(rng.rand(), 2)),
+                })
+
+    coco = COCO()
+    coco.dataset = {
+        'images': images,
+        'annotations': annotations,
+        'categories': [{'id': 1, 'name': 'person'}],
+    }
+    coco.createIndex()
+    return coco, results
+
+
+if __name__ == '__main__':
+    # parity check against pycocotools on synthetic data
+    import copy
+    from pycocotools.cocoeval import COCOeval
+
+    for seed in range(5):
+        coco_gt, results = _synthetic_coco(seed=seed)
+        coco_eval = COCOeval(
+            coco_gt, coco_gt.loadRes(copy.deepcopy(results)), 'keypoints'
+        )
+        coco_eval.params.useSegm = None
+        coco_eval.evaluate()
+        coco_eval.accumulate()
+        coco_eval.summarize()
+
+        for num_workers in [0, 2]:
+            stats = evaluate_keypoints(coco_gt, results, num_workers)
+            assert np.allclose(stats, coco_eval.stats), \
+                (seed, stats, coco_eval.stats)
+    print('=> coco_eval_fast matches pycocotools')
@@ -0,0 +1,170 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import logging
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from yacs.config import CfgNode as CN
+
+from utils.amp import autocast
+from utils.amp import get_autocast_dtype
+from utils.distributed import barrier
+from utils.distributed import get_device
+from utils.distributed import is_distributed
+from utils.distributed import is_main_process
+import models
+
+
+logger = logging.getLogger(__name__)
+
+
+def is_fixed_augmentation(config):
+    '''True if every epoch sees the same crop of each training sample'''
+    d = config.DATASET
+    return not d.FLIP and d.SCALE_FACTOR == 0 and d.ROT_FACTOR == 0 \
+        and d.PROB_HALF_BODY <= 0 and not d.OCC
+
+
+def get_teacher_config(config):
+    '''the student config with DISTILL.TEACHER_CFG merged on top'''
+    teacher_cfg = config.clone()
+    teacher_cfg.defrost()
+    teacher_cfg.MODEL.EXTRA = CN(new_allowed=True)
+    teacher_cfg.merge_from_file(config.DISTILL.TEACHER_CFG)
+    teacher_cfg.freeze()
+    return teacher_cfg
+
+
+class Teacher(object):
+    """
+    Frozen teacher for heatmap distillation. It runs without grad (and
+    autocast to DISTILL.PRECISION) on the student's input batch; its
+    heatmaps are resized to the student's HEATMAP_SIZE if they differ.
+    With DISTILL.CACHE_DIR and fixed augmentation the heatmaps are kept
+    in a float16 memmap indexed by meta['index'], so the teacher only
+    runs in the first epoch.
+    """
+    def __init__(self, config, num_samples):
+        self.heatmap_size = (
+            int(config.MODEL.HEATMAP_SIZE[1]), int(config.MODEL.HEATMAP_SIZE[0])
+        )
+        teacher_cfg = get_teacher_config(config)
+
+        model = eval('models.'+teacher_cfg.MODEL.NAME+'.get_pose_net')(
+            teacher_cfg, is_train=False
+        )
+        logger.info('=> loading teacher from {}'.format(
+            config.DISTILL.TEACHER_MODEL_FILE))
+        model.load_state_dict(torch.load(
+            config.DISTILL.TEACHER_MODEL_FILE, map_location='cpu'))
+        model.eval()
+        for param in model.parameters():
+            param.requires_grad_(False)
+
+        self.device = get_device(config)
+        if self.device.type == 'cuda' and not is_distributed():
+            model = torch.nn.DataParallel(
+                model, device_ids=config.GPUS).cuda()
+        else:
+            # a distributed rank runs the teacher on its own device
+            model = model.to(self.device)
+        self.model = model
+        self.autocast_dtype = get_autocast_dtype(
+            config.DISTILL.PRECISION, self.device)
+
+        self.heatmaps = None
+        if config.DISTILL.CACHE_DIR:
+            if is_fixed_augmentation(config):
+                self._open_cache(config, num_samples)
+            else:
+                logger.warning('=> teacher heatmaps are not cached, the '
+                               'training augmentation is random')
+
+    def _open_cache(self, config, num_samples):
+        # the cache is only valid for this teacher, data and crop size
+        key = hashlib.md5('|'.join([
+            config.DISTILL.TEACHER_CFG,
+            config.DISTILL.TEACHER_MODEL_FILE,
+            config.DATASET.ROOT,
+            config.DATASET.DATASET,
+            config.DATASET.TRAIN_SET,
+            str(config.DATASET.SELECT_DATA),
+            str(num_samples),
+            str(list(config.MODEL.IMAGE_SIZE)),
+            str(self.heatmap_size),
+        ]).encode()).hexdigest()[:16]
+        os.makedirs(config.DISTILL.CACHE_DIR, exist_ok=True)
+        prefix = os.path.join(config.DISTILL.CACHE_DIR, 'teacher_' + key)
+
+        num_joints = config.MODEL.NUM_JOINTS
+        shape = (num_samples, num_joints) + self.heatmap_size
+        # a cache of another shape, e.g. left by an interrupted creation,
+        # is rebuilt
+        valid = os.path.exists(prefix + '.heatmaps') \
+            and os.path.exists(prefix + '.filled') \
+            and os.path.getsize(prefix + '.heatmaps') \
+            == int(np.prod(shape)) * np.dtype(np.float16).itemsize \
+            and os.path.getsize(prefix + '.filled') == num_samples
+        # the ranks of a distributed run fill disjoint samples of the
+        # files rank 0 creates
+        if not valid and is_main_process():
+            if os.path.exists(prefix + '.heatmaps'):
+                logger.warning('=> rebuilding teacher heatmap cache {}, its '
+                               'size does not match'.format(prefix))
+            np.memmap(prefix + '.heatmaps', dtype=np.float16, mode='w+',
+                      shape=shape).flush()
+            np.memmap(prefix + '.filled', dtype=np.bool_, mode='w+',
+                      shape=(num_samples,)).flush()
+        barrier()
+        self.heatmaps = np.memmap(
+            prefix + '.heatmaps', dtype=np.float16, mode='r+', shape=shape)
+        self.filled = np.memmap(
+            prefix + '.filled', dtype=np.bool_, mode='r+',
+            shape=(num_samples,))
+        logger.info('=> teacher heatmap cache {} ({} of {} cached)'.format(
+            prefix, int(self.filled.sum()), num_samples))
+
+    def _forward(self, input):
+        with torch.no_grad(), autocast(self.device, self.autocast_dtype):
+            outputs = self.model(input)
+        if isinstance(outputs, list):
+            outputs = outputs[-1]
+        heatmaps = outputs.float()
+        if heatmaps.shape[-2:] != self.heatmap_size:
+            heatmaps = F.interpolate(
+                heatmaps, size=self.heatmap_size, mode='bilinear',
+                align_corners=False)
+        return heatmaps
+
+    def __call__(self, input, meta):
+        '''
+        :return: teacher heatmaps for the batch, on the input's device
+        '''
+        if self.heatmaps is None:
+            return self._forward(input).to(input.device)
+
+        index = meta['index'].numpy()
+        if self.filled[index].all():
+            heatmaps = torch.from_numpy(
+                np.ascontiguousarray(self.heatmaps[index]))
+            return heatmaps.to(input.device, non_blocking=True).float()
+
+        heatmaps = self._forward(input)
+        self.heatmaps[index] = heatmaps.half().cpu().numpy()
+        self.filled[index] = True
+        return heatmaps.to(input.device)
+
+    def flush(self):
+        if self.heatmaps is not None:
+            self.heatmaps.flush()
+            self.filled.flush()
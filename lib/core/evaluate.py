@@ -9,8 +9,10 @@ from __future__ import division
 from __future__ import print_function
 
 import numpy as np
+import torch
 
 from core.inference import get_max_preds
+from core.inference import get_max_preds_tensor
 
 
 def calc_dists(preds, target, normalize):
@@ -71,3 +73,26 @@ def accuracy(output, target, hm_type='gaussian', thr=0.5):
     return acc, avg_acc, cnt, pred
 
 
+def accuracy_tensor(output, target, thr=0.5):
+    '''
+    accuracy for gaussian heatmaps computed on the tensors' device,
+    returns avg_acc and cnt as 0-dim tensors so the caller decides when
+    to synchronize
+    '''
+    pred, _ = get_max_preds_tensor(output)
+    target, _ = get_max_preds_tensor(target)
+    h = output.size(2)
+    w = output.size(3)
+    norm = output.new_tensor([h, w]) / 10
+
+    valid = torch.gt(target[:, :, 0], 1) & torch.gt(target[:, :, 1], 1)
+    dists = torch.norm(pred / norm - target / norm, dim=2)
+    hits = torch.lt(dists, thr) & valid
+
+    num_valid = valid.sum(0)
+    joint_acc = hits.sum(0).float() / num_valid.clamp(min=1).float()
+    has_valid = torch.gt(num_valid, 0)
+    cnt = has_valid.sum()
+    avg_acc = (joint_acc * has_valid.float()).sum() / cnt.clamp(min=1).float()
+
+    return avg_acc, cnt, pred
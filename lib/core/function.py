@@ -8,6 +8,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import contextlib
 import time
 import logging
 import os
@@ -18,8 +19,19 @@ import torch
 from tqdm import tqdm
 
 from core.evaluate import accuracy
+from core.evaluate import accuracy_tensor
 from core.inference import get_final_preds
+from dataset.prefetcher import DataPrefetcher
+from utils.amp import autocast
+from utils.amp import get_autocast_dtype
+from utils.amp import get_memory_format
+from utils.amp import synchronize
+from utils.distributed import broadcast_object
+from utils.distributed import gather_arrays
+from utils.distributed import get_world_size
+from utils.distributed import is_main_process
 from utils.transforms import flip_back
+from utils.utils import get_model_device
 from utils.vis import save_debug_images
 
 
@@ -27,79 +39,197 @@ logger = logging.getLogger(__name__)
 
 
 def train(config, train_loader, model, criterion, optimizer, epoch,
-          output_dir, tb_log_dir, writer_dict):
+          output_dir, tb_log_dir, writer_dict, teacher=None, scaler=None,
+          lr_scheduler=None, checkpointer=None, start_iter=0):
+    '''
+    the forward and loss run autocast to TRAIN.PRECISION, the gradients of
+    TRAIN.ACCUM_STEPS batches are accumulated for every optimizer step
+    :param writer_dict: None on the ranks > 0 of a distributed run
+    :param teacher: core.distill.Teacher, adds DISTILL.WEIGHT times the
+                    loss against its heatmaps
+    :param scaler: GradScaler of utils.amp.get_grad_scaler for fp16
+    :param lr_scheduler: stepped after every optimizer step
+    :param checkpointer: utils.checkpoint.Checkpointer, may save after every
+                         optimizer step
+    :param start_iter: batches of the epoch already trained on, the loader
+                       starts after them
+    '''
     batch_time = AverageMeter()
     data_time = AverageMeter()
+    step_time = AverageMeter()
     losses = AverageMeter()
+    loss_time = AverageMeter()
+    distill_losses = AverageMeter()
     acc = AverageMeter()
 
     # switch to train mode
     model.train()
 
+    device = get_model_device(model)
+    autocast_dtype = get_autocast_dtype(config.TRAIN.PRECISION, device)
+    accum_steps = config.TRAIN.ACCUM_STEPS
+    num_batches = start_iter + len(train_loader)
+    distributed = isinstance(
+        model, torch.nn.parallel.DistributedDataParallel)
+
+    optimizer.zero_grad()
+    step_start = time.time()
+    step_samples = 0
+    step_speed = 0.
     end = time.time()
-    pbar = tqdm(train_loader)
-    for i, (input, target, target_weight, meta) in enumerate(pbar):
+    pbar = tqdm(DataPrefetcher(train_loader, device), initial=start_iter,
+                total=num_batches, disable=not is_main_process())
+    for i, (input, target, target_weight, meta) in enumerate(pbar, start_iter):
         # measure data loading time
         data_time.update(time.time() - end)
 
-        # compute output
-        outputs = model(input)
-
-        target = target.cuda(non_blocking=True)
-        target_weight = target_weight.cuda(non_blocking=True)
-
-        if isinstance(outputs, list):
-            loss = criterion(outputs[0], target, target_weight)
-            for output in outputs[1:]:
-                loss += criterion(output, target, target_weight)
-        else:
-            output = outputs
-            loss = criterion(output, target, target_weight)
-
-        # loss = criterion(output, target, target_weight)
-
-        # compute gradient and do update step
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        # the teacher runs in its own DISTILL.PRECISION
+        if teacher is not None:
+            teacher_heatmaps = teacher(input, meta)
+
+        # the last accumulation of the epoch may have fewer batches
+        first = i - i % accum_steps
+        num_accumulated = min(accum_steps, num_batches - first)
+        is_step = i + 1 == first + num_accumulated
+        # ddp only all-reduces the gradients of the last batch of a step
+        no_sync = model.no_sync() if distributed and not is_step \
+            else contextlib.nullcontext()
+
+        with no_sync:
+            with autocast(device, autocast_dtype):
+                # compute output
+                outputs = model(input)
+                # the losses are computed on the fp32 heatmaps
+                if isinstance(outputs, list):
+                    outputs = [output.float() for output in outputs]
+                else:
+                    outputs = outputs.float()
+
+                # the loss is only timed when printing, timing has to sync
+                timed = i % config.PRINT_FREQ == 0
+                if timed:
+                    synchronize(input.device)
+                    loss_start = time.time()
+
+                if isinstance(outputs, list):
+                    loss = criterion(outputs[0], target, target_weight)
+                    for output in outputs[1:]:
+                        loss += criterion(output, target, target_weight)
+                else:
+                    output = outputs
+                    loss = criterion(output, target, target_weight)
+
+                # loss = criterion(output, target, target_weight)
+
+                if timed:
+                    synchronize(input.device)
+                    loss_time.update((time.time() - loss_start) * 1000)
+
+                # train_loss stays the ground truth loss, the distill term
+                # is only backpropagated and logged as train_distill_loss
+                total_loss = loss
+                if teacher is not None:
+                    student_output = outputs[-1] \
+                        if isinstance(outputs, list) else outputs
+                    distill_loss = criterion(
+                        student_output, teacher_heatmaps, target_weight)
+                    total_loss = loss + config.DISTILL.WEIGHT * distill_loss
+                    distill_losses.update(
+                        distill_loss.detach(), input.size(0))
+
+            # compute gradient, the mean over the accumulated batches
+            if scaler is not None:
+                scaler.scale(total_loss / num_accumulated).backward()
+            else:
+                (total_loss / num_accumulated).backward()
+        step_samples += input.size(0)
+
+        # do update step
+        if is_step:
+            if scaler is not None:
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                optimizer.step()
+            optimizer.zero_grad()
+            if lr_scheduler is not None:
+                lr_scheduler.step()
 
-        # measure accuracy and record loss
-        losses.update(loss.item(), input.size(0))
+            step_time.update(time.time() - step_start)
+            step_speed = step_samples * get_world_size() / step_time.val
+            step_start = time.time()
+            step_samples = 0
 
-        _, avg_acc, cnt, pred = accuracy(output.detach().cpu().numpy(),
-                                         target.detach().cpu().numpy())
-        acc.update(avg_acc, cnt)
+        # record loss, kept on the device until it is printed so the
+        # host does not wait for the gpu every iteration
+        losses.update(loss.detach(), input.size(0))
 
         # measure elapsed time
         batch_time.update(time.time() - end)
         end = time.time()
 
         if i % config.PRINT_FREQ == 0:
+            # accuracy is only sampled at print time
+            avg_acc, cnt, pred = accuracy_tensor(output.detach(), target)
+            acc.update(avg_acc.item(), cnt.item())
+            pred = pred.cpu().numpy()
+
             msg = 'Epoch: [{0}][{1}/{2}]\t' \
                   'Time {batch_time.val:.3f}s ({batch_time.avg:.3f}s)\t' \
                   'Speed {speed:.1f} samples/s\t' \
+                  'Step {step_time.val:.3f}s ({step_speed:.1f} samples/s)\t' \
                   'Data {data_time.val:.3f}s ({data_time.avg:.3f}s)\t' \
                   'Loss {loss.val:.5f} ({loss.avg:.5f})\t' \
+                  'Loss time {loss_time.val:.2f}ms ({loss_time.avg:.2f}ms)\t' \
                   'Accuracy {acc.val:.3f} ({acc.avg:.3f})'.format(
-                      epoch, i, len(train_loader), batch_time=batch_time,
+                      epoch, i, num_batches, batch_time=batch_time,
                       speed=input.size(0)/batch_time.val,
-                      data_time=data_time, loss=losses, acc=acc)
+                      step_time=step_time, step_speed=step_speed,
+                      data_time=data_time, loss=losses,
+                      loss_time=loss_time, acc=acc)
             #logger.info(msg)
-            pbar.set_description(f'epoch:{epoch}, loss:{losses.val:.5f}, acc:{acc.val:.3f}')
-
-            writer = writer_dict['writer']
-            global_steps = writer_dict['train_global_steps']
-            writer.add_scalar('train_loss', losses.val, global_steps)
-            writer.add_scalar('train_acc', acc.val, global_steps)
-            writer_dict['train_global_steps'] = global_steps + 1
-
-            prefix = '{}_{}'.format(os.path.join(output_dir, 'train'), i)
-            save_debug_images(config, input, meta, target, pred*4, output,
-                              prefix)
+            pbar.set_description(f'epoch:{epoch}, loss:{losses.val:.5f}, loss_ms:{loss_time.val:.2f}, acc:{acc.val:.3f}, {step_speed:.1f} samples/s')
+
+            if writer_dict:
+                writer = writer_dict['writer']
+                global_steps = writer_dict['train_global_steps']
+                writer.add_scalar('train_loss', float(losses.val),
+                                  global_steps)
+                writer.add_scalar('train_acc', acc.val, global_steps)
+                writer.add_scalar('train_loss_ms', loss_time.val,
+                                  global_steps)
+                writer.add_scalar('train_samples_per_sec', step_speed,
+                                  global_steps)
+                if teacher is not None:
+                    writer.add_scalar('train_distill_loss',
+                                      float(distill_losses.val), global_steps)
+                writer_dict['train_global_steps'] = global_steps + 1
+
+            if is_main_process():
+                prefix = '{}_{}'.format(os.path.join(output_dir, 'train'), i)
+                save_debug_images(config, input, meta, target, pred*4,
+                                  output, prefix)
+
+        # after the tensorboard steps of this batch, a resumed run
+        # continues with the next one
+        if is_step and checkpointer is not None:
+            checkpointer.step(epoch, i + 1)
+
+    logger.info('=> epoch {}: {} forward {:.2f}ms per step'.format(
+        epoch, criterion.__class__.__name__, loss_time.avg))
+    logger.info('=> epoch {}: {} optimizer steps, {:.3f}s per step'.format(
+        epoch, step_time.count, step_time.avg))
 
 
 def validate(config, val_loader, val_dataset, model, criterion, output_dir,
-             tb_log_dir, writer_dict=None):
+             tb_log_dir, writer_dict=None, evaluator=None, eval_tag=None):
+    '''
+    with an evaluator (core.async_eval.AsyncEvaluator) only the inference
+    runs here, the predictions are evaluated in the background and None
+    is returned, see log_evaluation. In a distributed run each rank
+    infers the shard of its val_loader sampler and the perf_indicator of
+    rank 0 is returned on every rank
+    '''
     batch_time = AverageMeter()
     losses = AverageMeter()
     acc = AverageMeter()
@@ -107,7 +237,7 @@ def validate(config, val_loader, val_dataset, model, criterion, output_dir,
     # switch to evaluate mode
     model.eval()
 
-    num_samples = len(val_dataset)
+    num_samples = len(val_loader.sampler)
     all_preds = np.zeros(
         (num_samples, config.MODEL.NUM_JOINTS, 3),
         dtype=np.float32
@@ -117,31 +247,40 @@ def validate(config, val_loader, val_dataset, model, criterion, output_dir,
     filenames = []
     imgnums = []
     idx = 0
+    device = get_model_device(model)
+    autocast_dtype = get_autocast_dtype(config.TEST.PRECISION, device)
+    memory_format = get_memory_format(config)
     with torch.no_grad():
         end = time.time()
-        for i, (input, target, target_weight, meta) in enumerate(val_loader):
+        prefetcher = DataPrefetcher(val_loader, device)
+        for i, (input, target, target_weight, meta) in enumerate(prefetcher):
+            input = input.contiguous(memory_format=memory_format)
             # compute output
-            outputs = model(input)
+            with autocast(device, autocast_dtype):
+                outputs = model(input)
             if isinstance(outputs, list):
                 output = outputs[-1]
             else:
                 output = outputs
+            output = output.float()
 
             if config.TEST.FLIP_TEST:
-                # this part is ugly, because pytorch has not supported negative index
-                # input_flipped = model(input[:, :, :, ::-1])
-                input_flipped = np.flip(input.cpu().numpy(), 3).copy()
-                input_flipped = torch.from_numpy(input_flipped).cuda()
-                outputs_flipped = model(input_flipped)
+                # flip on the device, the input is already there
+                input_flipped = torch.flip(input, [3]).contiguous(
+                    memory_format=memory_format)
+                with autocast(device, autocast_dtype):
+                    outputs_flipped = model(input_flipped)
 
                 if isinstance(outputs_flipped, list):
                     output_flipped = outputs_flipped[-1]
                 else:
                     output_flipped = outputs_flipped
+                output_flipped = output_flipped.float()
 
                 output_flipped = flip_back(output_flipped.cpu().numpy(),
                                            val_dataset.flip_pairs)
-                output_flipped = torch.from_numpy(output_flipped.copy()).cuda()
+                output_flipped = torch.from_numpy(output_flipped.copy()).to(
+                    output.device)
 
 
                 # feature is not aligned, shift flipped heatmap for higher accuracy
@@ -151,9 +290,6 @@ def validate(config, val_loader, val_dataset, model, criterion, output_dir,
 
                 output = (output + output_flipped) * 0.5
 
-            target = target.cuda(non_blocking=True)
-            target_weight = target_weight.cuda(non_blocking=True)
-
             loss = criterion(output, target, target_weight)
 
             num_images = input.size(0)
@@ -195,23 +331,45 @@ def validate(config, val_loader, val_dataset, model, criterion, output_dir,
                           loss=losses, acc=acc)
                 logger.info(msg)
 
-                prefix = '{}_{}'.format(
-                    os.path.join(output_dir, 'val'), i
-                )
-                save_debug_images(config, input, meta, target, pred*4, output,
-                                  prefix)
-
-        name_values, perf_indicator = val_dataset.evaluate(
-            config, all_preds, output_dir, all_boxes, image_path,
-            filenames, imgnums
-        )
-
-        model_name = config.MODEL.NAME
-        if isinstance(name_values, list):
-            for name_value in name_values:
-                _print_name_value(name_value, model_name)
+                if is_main_process():
+                    prefix = '{}_{}'.format(
+                        os.path.join(output_dir, 'val'), i
+                    )
+                    save_debug_images(config, input, meta, target, pred*4,
+                                      output, prefix)
+
+        distributed = get_world_size() > 1
+        evaluate_here = True
+        if distributed and not getattr(val_dataset, 'evaluates_shards', False):
+            # the dataset can only evaluate the whole set, on rank 0 and
+            # in dataset order
+            gathered = gather_arrays(
+                all_preds, all_boxes, image_path,
+                np.array(list(val_loader.sampler), dtype=np.int64)
+            )
+            evaluate_here = gathered is not None
+            if evaluate_here:
+                order = np.argsort(gathered[3])
+                all_preds = gathered[0][order]
+                all_boxes = gathered[1][order]
+                image_path = [gathered[2][k] for k in order]
+
+        if evaluator is not None:
+            evaluator.submit(
+                all_preds, all_boxes, image_path, filenames, imgnums,
+                tag=eval_tag
+            )
+            name_values, perf_indicator = None, None
+        elif evaluate_here:
+            name_values, perf_indicator = val_dataset.evaluate(
+                config, all_preds, output_dir, all_boxes, image_path,
+                filenames, imgnums
+            )
         else:
-            _print_name_value(name_values, model_name)
+            name_values, perf_indicator = None, None
+
+        if distributed and evaluator is None:
+            perf_indicator = broadcast_object(perf_indicator)
 
         if writer_dict:
             writer = writer_dict['writer']
@@ -226,22 +384,39 @@ def validate(config, val_loader, val_dataset, model, criterion, output_dir,
                 acc.avg,
                 global_steps
             )
-            if isinstance(name_values, list):
-                for name_value in name_values:
-                    writer.add_scalars(
-                        'valid',
-                        dict(name_value),
-                        global_steps
-                    )
-            else:
+            writer_dict['valid_global_steps'] = global_steps + 1
+        else:
+            global_steps = None
+
+        if name_values is not None:
+            log_evaluation(config, name_values, writer_dict, global_steps)
+
+    return perf_indicator
+
+
+def log_evaluation(config, name_values, writer_dict=None, global_steps=None):
+    model_name = config.MODEL.NAME
+    if isinstance(name_values, list):
+        for name_value in name_values:
+            _print_name_value(name_value, model_name)
+    else:
+        _print_name_value(name_values, model_name)
+
+    if writer_dict:
+        writer = writer_dict['writer']
+        if isinstance(name_values, list):
+            for name_value in name_values:
                 writer.add_scalars(
                     'valid',
-                    dict(name_values),
+                    dict(name_value),
                     global_steps
                 )
-            writer_dict['valid_global_steps'] = global_steps + 1
-
-    return perf_indicator
+        else:
+            writer.add_scalars(
+                'valid',
+                dict(name_values),
+                global_steps
+            )
 
 
 # markdown format output
@@ -11,6 +11,7 @@ from __future__ import print_function
 import math
 
 import numpy as np
+import torch
 
 from utils.transforms import transform_preds
 
@@ -46,6 +47,27 @@ def get_max_preds(batch_heatmaps):
     return preds, maxvals
 
 
+def get_max_preds_tensor(batch_heatmaps):
+    '''
+    get_max_preds for torch tensors, runs on the heatmaps' device
+    heatmaps: torch.Tensor([batch_size, num_joints, height, width])
+    '''
+    batch_size = batch_heatmaps.size(0)
+    num_joints = batch_heatmaps.size(1)
+    width = batch_heatmaps.size(3)
+    heatmaps_reshaped = batch_heatmaps.reshape((batch_size, num_joints, -1))
+    maxvals, idx = torch.max(heatmaps_reshaped, 2, keepdim=True)
+
+    preds = idx.repeat(1, 1, 2).float()
+    preds[:, :, 0] = (preds[:, :, 0]) % width
+    preds[:, :, 1] = torch.floor((preds[:, :, 1]) / width)
+
+    pred_mask = torch.gt(maxvals, 0.0).repeat(1, 1, 2).float()
+
+    preds *= pred_mask
+    return preds, maxvals
+
+
 def get_final_preds(config, batch_heatmaps, center, scale):
     coords, maxvals = get_max_preds(batch_heatmaps)
 
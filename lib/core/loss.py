@@ -8,77 +8,138 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import logging
+
 import torch
 import torch.nn as nn
 
 
+logger = logging.getLogger(__name__)
+
+
+def joints_squared_error(output, target, target_weight, use_target_weight):
+    '''
+    :return: (pred - gt)^2 * w^2 per heatmap pixel, [batch, joints, H*W]
+    '''
+    batch_size = output.size(0)
+    num_joints = output.size(1)
+    diff = output.reshape((batch_size, num_joints, -1)) \
+        - target.reshape((batch_size, num_joints, -1))
+    if use_target_weight:
+        diff = diff * target_weight.reshape((batch_size, num_joints, 1))
+    return diff * diff
+
+
 class JointsMSELoss(nn.Module):
     def __init__(self, use_target_weight):
         super(JointsMSELoss, self).__init__()
-        self.criterion = nn.MSELoss(reduction='mean')
         self.use_target_weight = use_target_weight
 
     def forward(self, output, target, target_weight):
-        batch_size = output.size(0)
-        num_joints = output.size(1)
-        heatmaps_pred = output.reshape((batch_size, num_joints, -1)).split(1, 1)
-        heatmaps_gt = target.reshape((batch_size, num_joints, -1)).split(1, 1)
-        loss = 0
-
-        for idx in range(num_joints):
-            heatmap_pred = heatmaps_pred[idx].squeeze()
-            heatmap_gt = heatmaps_gt[idx].squeeze()
-            if self.use_target_weight:
-                loss += 0.5 * self.criterion(
-                    heatmap_pred.mul(target_weight[:, idx]),
-                    heatmap_gt.mul(target_weight[:, idx])
-                )
-            else:
-                loss += 0.5 * self.criterion(heatmap_pred, heatmap_gt)
-
-        return loss / num_joints
+        return 0.5 * joints_squared_error(
+            output, target, target_weight, self.use_target_weight
+        ).mean()
 
 
 class JointsOHKMMSELoss(nn.Module):
     def __init__(self, use_target_weight, topk=8):
         super(JointsOHKMMSELoss, self).__init__()
-        self.criterion = nn.MSELoss(reduction='none')
         self.use_target_weight = use_target_weight
         self.topk = topk
 
     def ohkm(self, loss):
-        ohkm_loss = 0.
-        for i in range(loss.size()[0]):
-            sub_loss = loss[i]
-            topk_val, topk_idx = torch.topk(
-                sub_loss, k=self.topk, dim=0, sorted=False
-            )
-            tmp_loss = torch.gather(sub_loss, 0, topk_idx)
-            ohkm_loss += torch.sum(tmp_loss) / self.topk
-        ohkm_loss /= loss.size()[0]
-        return ohkm_loss
+        # mean of the topk joint losses of each sample, then over the batch
+        topk_val, _ = torch.topk(loss, k=self.topk, dim=1, sorted=False)
+        return topk_val.mean()
+
+    def forward(self, output, target, target_weight):
+        loss = 0.5 * joints_squared_error(
+            output, target, target_weight, self.use_target_weight
+        ).mean(dim=2)
+
+        return self.ohkm(loss)
+
+
+def _weighted_diff(output, target, weight):
+    weighted_diff = (output - target) * weight
+    return weighted_diff, weighted_diff * weight
+
+
+_scripted_weighted_diff = None
+
+
+class _FusedWeightedMSE(torch.autograd.Function):
+    """
+    0.5 * mean(((pred - gt) * w)^2) that only keeps (pred - gt) * w^2 for
+    the backward, autograd would keep the difference and the weighted
+    difference
+    """
+    @staticmethod
+    def forward(ctx, output, target, weight):
+        weighted_diff, grad = _scripted_weighted_diff(output, target, weight)
+        ctx.save_for_backward(grad)
+        return 0.5 * weighted_diff.pow(2).mean()
+
+    @staticmethod
+    def backward(ctx, grad_loss):
+        grad, = ctx.saved_tensors
+        grad_output = grad * (grad_loss / grad.numel())
+        grad_target = -grad_output if ctx.needs_input_grad[1] else None
+        return grad_output, grad_target, None
+
+
+class JointsFusedMSELoss(nn.Module):
+    '''
+    JointsMSELoss in one fused elementwise pass with a hand written
+    backward, for the same value and gradients
+    '''
+    def __init__(self, use_target_weight):
+        super(JointsFusedMSELoss, self).__init__()
+        self.use_target_weight = use_target_weight
+
+        # scripted so the elementwise ops run as one fused kernel on gpu
+        global _scripted_weighted_diff
+        if _scripted_weighted_diff is None:
+            _scripted_weighted_diff = torch.jit.script(_weighted_diff)
 
     def forward(self, output, target, target_weight):
         batch_size = output.size(0)
         num_joints = output.size(1)
-        heatmaps_pred = output.reshape((batch_size, num_joints, -1)).split(1, 1)
-        heatmaps_gt = target.reshape((batch_size, num_joints, -1)).split(1, 1)
-
-        loss = []
-        for idx in range(num_joints):
-            heatmap_pred = heatmaps_pred[idx].squeeze()
-            heatmap_gt = heatmaps_gt[idx].squeeze()
-            if self.use_target_weight:
-                loss.append(0.5 * self.criterion(
-                    heatmap_pred.mul(target_weight[:, idx]),
-                    heatmap_gt.mul(target_weight[:, idx])
-                ))
-            else:
-                loss.append(
-                    0.5 * self.criterion(heatmap_pred, heatmap_gt)
-                )
-
-        loss = [l.mean(dim=1).unsqueeze(dim=1) for l in loss]
-        loss = torch.cat(loss, dim=1)
+        output = output.reshape((batch_size, num_joints, -1))
+        target = target.reshape((batch_size, num_joints, -1)).to(output.dtype)
+        if self.use_target_weight:
+            weight = target_weight.reshape((batch_size, num_joints, 1))
+        else:
+            weight = output.new_ones((1, 1, 1))
+        return _FusedWeightedMSE.apply(output, target, weight.to(output.dtype))
 
-        return self.ohkm(loss)
+
+LOSSES = {
+    'mse': JointsMSELoss,
+    'ohkm_mse': JointsOHKMMSELoss,
+    'fused_mse': JointsFusedMSELoss,
+}
+
+
+def get_loss(config):
+    '''
+    the criterion named by LOSS.NAME, or by LOSS.USE_OHKM if it is empty
+    '''
+    name = config.LOSS.NAME or ('ohkm_mse' if config.LOSS.USE_OHKM else 'mse')
+    if name not in LOSSES:
+        raise ValueError('unknown LOSS.NAME {}, expected one of {}'.format(
+            name, sorted(LOSSES)))
+
+    if name == 'ohkm_mse':
+        criterion = JointsOHKMMSELoss(
+            use_target_weight=config.LOSS.USE_TARGET_WEIGHT,
+            topk=config.LOSS.TOPK
+        )
+        logger.info('=> loss: {} (top {} joints)'.format(
+            name, config.LOSS.TOPK))
+    else:
+        criterion = LOSSES[name](
+            use_target_weight=config.LOSS.USE_TARGET_WEIGHT
+        )
+        logger.info('=> loss: {}'.format(name))
+    return criterion
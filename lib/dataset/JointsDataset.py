@@ -64,6 +64,10 @@ class JointsDataset(Dataset):
         self.center_jitter = [-0.5, 0.5]
         self.mask_shapes = ['triangle', 'rectangle', 'ellipse']
 
+        # set by set_epoch
+        self.epoch = 0
+        self.seed = None
+
     def _get_db(self):
         raise NotImplementedError
 
@@ -118,6 +122,21 @@ class JointsDataset(Dataset):
     def __len__(self,):
         return len(self.db)
 
+    def set_epoch(self, epoch, seed):
+        '''
+        seed the augmentation of each training sample from the seed, the
+        epoch and its index, so it does not depend on the dataloader worker
+        and a resumed epoch sees the same crops
+        '''
+        self.epoch = epoch
+        self.seed = seed
+
+    def _seed_augmentation(self, idx):
+        np_seed, py_seed = np.random.SeedSequence(
+            [self.seed, self.epoch, idx]).generate_state(2)
+        np.random.seed(np_seed)
+        random.seed(int(py_seed))
+
     def __getitem__(self, idx):
         db_rec = copy.deepcopy(self.db[idx])
 
@@ -151,6 +170,9 @@ class JointsDataset(Dataset):
         r = 0
 
         if self.is_train:
+            if self.seed is not None:
+                self._seed_augmentation(idx)
+
             if (np.sum(joints_vis[:, 0]) > self.num_joints_half_body
                 and np.random.rand() < self.prob_half_body):
                 c_half_body, s_half_body = self.half_body_transform(
@@ -197,6 +219,7 @@ class JointsDataset(Dataset):
         target_weight = torch.from_numpy(target_weight)
 
         meta = {
+            'index': idx,
             'image': image_file,
             'filename': filename,
             'imgnum': imgnum,
@@ -11,21 +11,68 @@ from __future__ import print_function
 from collections import defaultdict
 from collections import OrderedDict
 import logging
+import multiprocessing
 import os
+import threading
+import time
 
 from pycocotools.coco import COCO
 from pycocotools.cocoeval import COCOeval
 import json_tricks as json
 import numpy as np
 
+from core.coco_eval_fast import evaluate_keypoints
 from dataset.JointsDataset import JointsDataset
 from nms.nms import oks_nms
 from nms.nms import soft_oks_nms
+from utils.distributed import barrier
+from utils.distributed import get_world_size
+from utils.distributed import is_main_process
+from utils.utils import load_cached
 
 
 logger = logging.getLogger(__name__)
 
 
+def _rescore_and_nms(images, num_joints, in_vis_thre, oks_thre, soft_nms):
+    '''
+    rescore every person by its mean visible keypoint confidence, then
+    oks nms the people of each image
+    '''
+    oks_nmsed_kpts = []
+    for img_kpts in images:
+        for n_p in img_kpts:
+            box_score = n_p['score']
+            kpt_score = 0
+            valid_num = 0
+            for n_jt in range(0, num_joints):
+                t_s = n_p['keypoints'][n_jt][2]
+                if t_s > in_vis_thre:
+                    kpt_score = kpt_score + t_s
+                    valid_num = valid_num + 1
+            if valid_num != 0:
+                kpt_score = kpt_score / valid_num
+            # rescoring
+            n_p['score'] = kpt_score * box_score
+
+        if soft_nms:
+            keep = soft_oks_nms(
+                [img_kpts[i] for i in range(len(img_kpts))],
+                oks_thre
+            )
+        else:
+            keep = oks_nms(
+                [img_kpts[i] for i in range(len(img_kpts))],
+                oks_thre
+            )
+
+        if len(keep) == 0:
+            oks_nmsed_kpts.append(img_kpts)
+        else:
+            oks_nmsed_kpts.append([img_kpts[_keep] for _keep in keep])
+    return oks_nmsed_kpts
+
+
 class COCODataset(JointsDataset):
     '''
     "keypoints": {
@@ -60,12 +107,20 @@ class COCODataset(JointsDataset):
         self.in_vis_thre = cfg.TEST.IN_VIS_THRE
         self.bbox_file = cfg.TEST.COCO_BBOX_FILE
         self.use_gt_bbox = cfg.TEST.USE_GT_BBOX
+        self.save_results = cfg.TEST.SAVE_RESULTS
+        self.fast_coco_eval = cfg.TEST.FAST_COCO_EVAL
+        self.eval_workers = cfg.TEST.EVAL_WORKERS
         self.image_width = cfg.MODEL.IMAGE_SIZE[0]
         self.image_height = cfg.MODEL.IMAGE_SIZE[1]
         self.aspect_ratio = self.image_width * 1.0 / self.image_height
         self.pixel_std = 200
+        self.cache_dir = cfg.DATASET.CACHE_DIR
 
-        self.coco = COCO(self._get_ann_file_keypoint())
+        ann_file = self._get_ann_file_keypoint()
+        ann_key = self._file_key(ann_file)
+        self.coco = load_cached(
+            self.cache_dir, 'coco_' + self.image_set, ann_key,
+            lambda: COCO(ann_file))
 
         # deal with class names
         cats = [cat['name']
@@ -102,15 +157,29 @@ class COCODataset(JointsDataset):
             dtype=np.float32
         ).reshape((self.num_joints, 1))
 
-        self.db = self._get_db()
+        # the db depends on the boxes and the aspect ratio of the crops
+        self.db = load_cached(
+            self.cache_dir, 'db_' + self.image_set, (
+                ann_key, self.root, self.data_format, self.is_train,
+                self.use_gt_bbox, self._file_key(self.bbox_file),
+                self.image_thre, self.aspect_ratio
+            ), self._get_db)
 
         if is_train and cfg.DATASET.SELECT_DATA:
             self.db = self.select_data(self.db)
 
         self.args = args
+        self._results_writer = None
 
         logger.info('=> load {} samples'.format(len(self.db)))
 
+    @staticmethod
+    def _file_key(path):
+        if not path or not os.path.exists(path):
+            return path
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_size, stat.st_mtime
+
     def _get_ann_file_keypoint(self):
         """ self.root / annotations / person_keypoints_train2017.json """
         prefix = 'person_keypoints' \
@@ -288,6 +357,10 @@ class COCODataset(JointsDataset):
             self.image_thre, num_boxes))
         return kpt_db
 
+    # in a distributed run every rank saves the predictions of its shard
+    # of the images, rank 0 merges them before rescoring, nms and cocoeval
+    evaluates_shards = True
+
     def evaluate(self, cfg, preds, output_dir, all_boxes, img_path,
                  *args, **kwargs):
         rank = cfg.RANK
@@ -299,75 +372,102 @@ class COCODataset(JointsDataset):
             except Exception:
                 logger.error('Fail to make {}'.format(res_folder))
 
+        image_ids = np.array(
+            [int(path[-16:-4]) for path in img_path], dtype=np.int64)
+
+        world_size = get_world_size()
+        if world_size > 1:
+            np.savez(
+                self._preds_shard_file(res_folder, rank),
+                preds=preds, boxes=all_boxes, image_ids=image_ids
+            )
+            barrier()
+            if not is_main_process():
+                return None, None
+            preds, all_boxes, image_ids = self._merge_preds_shards(
+                res_folder, world_size)
+
         res_file = os.path.join(
             res_folder, 'keypoints_{}_results_{}.json'.format(
                 self.image_set, rank)
         )
 
-        # person x (keypoints)
-        _kpts = []
+        # image x person x (keypoints)
+        kpts = defaultdict(list)
         for idx, kpt in enumerate(preds):
-            _kpts.append({
+            kpts[int(image_ids[idx])].append({
                 'keypoints': kpt,
                 'center': all_boxes[idx][0:2],
                 'scale': all_boxes[idx][2:4],
                 'area': all_boxes[idx][4],
                 'score': all_boxes[idx][5],
-                'image': int(img_path[idx][-16:-4])
+                'image': int(image_ids[idx])
             })
-        # image x person x (keypoints)
-        kpts = defaultdict(list)
-        for kpt in _kpts:
-            kpts[kpt['image']].append(kpt)
-
-        # rescoring and oks nms
-        num_joints = self.num_joints
-        in_vis_thre = self.in_vis_thre
-        oks_thre = self.oks_thre
-        oks_nmsed_kpts = []
-        for img in kpts.keys():
-            img_kpts = kpts[img]
-            for n_p in img_kpts:
-                box_score = n_p['score']
-                kpt_score = 0
-                valid_num = 0
-                for n_jt in range(0, num_joints):
-                    t_s = n_p['keypoints'][n_jt][2]
-                    if t_s > in_vis_thre:
-                        kpt_score = kpt_score + t_s
-                        valid_num = valid_num + 1
-                if valid_num != 0:
-                    kpt_score = kpt_score / valid_num
-                # rescoring
-                n_p['score'] = kpt_score * box_score
-
-            if self.soft_nms:
-                keep = soft_oks_nms(
-                    [img_kpts[i] for i in range(len(img_kpts))],
-                    oks_thre
-                )
-            else:
-                keep = oks_nms(
-                    [img_kpts[i] for i in range(len(img_kpts))],
-                    oks_thre
-                )
-
-            if len(keep) == 0:
-                oks_nmsed_kpts.append(img_kpts)
-            else:
-                oks_nmsed_kpts.append([img_kpts[_keep] for _keep in keep])
-
-        self._write_coco_keypoint_results(
-            oks_nmsed_kpts, res_file)
+
+        oks_nmsed_kpts = self._rescore_and_nms(list(kpts.values()))
+        results = self._coco_keypoint_results(oks_nmsed_kpts)
+
+        # the results file is a side output, cocoeval reads the results
+        # from memory, so it is written in the background
+        if self.save_results or 'test' in self.image_set:
+            self._write_coco_keypoint_results_async(results, res_file)
+
         if 'test' not in self.image_set:
             info_str = self._do_python_keypoint_eval(
-                res_file, res_folder)
+                results, res_folder)
             name_value = OrderedDict(info_str)
             return name_value, name_value['AP']
         else:
             return {'Null': 0}, 0
 
-    def _write_coco_keypoint_results(self, keypoints, res_file):
+    def _preds_shard_file(self, res_folder, rank):
+        return os.path.join(
+            res_folder, 'keypoints_{}_preds_{}.npz'.format(
+                self.image_set, rank)
+        )
+
+    def _merge_preds_shards(self, res_folder, world_size):
+        shards = []
+        for rank in range(world_size):
+            with np.load(self._preds_shard_file(res_folder, rank)) as shard:
+                shards.append(
+                    (shard['preds'], shard['boxes'], shard['image_ids']))
+        preds, boxes, image_ids = [
+            np.concatenate(arrays) for arrays in zip(*shards)
+        ]
+        logger.info('=> merged the predictions of {} ranks: {} boxes'.format(
+            world_size, len(preds)))
+        return preds, boxes, image_ids
+
+    def _rescore_and_nms(self, images):
+        '''
+        :param images: image x person (keypoints)
+        :return: image x person kept by oks nms, over TEST.EVAL_WORKERS
+                 processes if > 0
+        '''
+        args = (self.num_joints, self.in_vis_thre, self.oks_thre,
+                self.soft_nms)
+        num_workers = self.eval_workers
+        if num_workers > 0 and multiprocessing.current_process().daemon:
+            # daemonic processes (e.g. pool workers) may not have children
+            num_workers = 0
+
+        start = time.time()
+        if num_workers > 0:
+            chunk = int(np.ceil(len(images) / float(num_workers)))
+            shards = [images[i:i + chunk]
+                      for i in range(0, len(images), chunk)]
+            with multiprocessing.Pool(num_workers) as pool:
+                kept = sum(pool.starmap(
+                    _rescore_and_nms, [(shard,) + args for shard in shards]
+                ), [])
+        else:
+            kept = _rescore_and_nms(images, *args)
+        logger.info('=> rescoring and oks nms of {} images: {:.2f}s'.format(
+            len(images), time.time() - start))
+        return kept
+
+    def _coco_keypoint_results(self, keypoints):
         data_pack = [
             {
                 'cat_id': self._class_to_coco_ind[cls],
@@ -379,7 +479,25 @@ class COCODataset(JointsDataset):
             for cls_ind, cls in enumerate(self.classes) if not cls == '__background__'
         ]
 
-        results = self._coco_keypoint_results_one_category_kernel(data_pack[0])
+        return self._coco_keypoint_results_one_category_kernel(data_pack[0])
+
+    def _write_coco_keypoint_results_async(self, results, res_file):
+        self.wait_for_results_writer()
+        # loadRes adds 'area', 'bbox' and 'id' to the result dicts, so the
+        # writer gets its own shallow copies
+        results = [dict(result) for result in results]
+        self._results_writer = threading.Thread(
+            target=self._write_coco_keypoint_results,
+            args=(results, res_file)
+        )
+        self._results_writer.start()
+
+    def wait_for_results_writer(self):
+        if self._results_writer is not None:
+            self._results_writer.join()
+            self._results_writer = None
+
+    def _write_coco_keypoint_results(self, results, res_file):
         logger.info('=> writing results json to %s' % res_file)
         with open(res_file, 'w') as f:
             json.dump(results, f, sort_keys=True, indent=4)
@@ -406,14 +524,9 @@ class COCODataset(JointsDataset):
 
             _key_points = np.array([img_kpts[k]['keypoints']
                                     for k in range(len(img_kpts))])
-            key_points = np.zeros(
-                (_key_points.shape[0], self.num_joints * 3), dtype=np.float
-            )
-
-            for ipt in range(self.num_joints):
-                key_points[:, ipt * 3 + 0] = _key_points[:, ipt, 0]
-                key_points[:, ipt * 3 + 1] = _key_points[:, ipt, 1]
-                key_points[:, ipt * 3 + 2] = _key_points[:, ipt, 2]  # keypoints score.
+            key_points = _key_points.reshape(
+                (_key_points.shape[0], self.num_joints * 3)
+            ).astype(np.float64)
 
             result = [
                 {
@@ -430,18 +543,26 @@ class COCODataset(JointsDataset):
 
         return cat_results
 
-    def _do_python_keypoint_eval(self, res_file, res_folder):
-        coco_dt = self.coco.loadRes(res_file)
-        coco_eval = COCOeval(self.coco, coco_dt, 'keypoints')
-        coco_eval.params.useSegm = None
-        coco_eval.evaluate()
-        coco_eval.accumulate()
-        coco_eval.summarize()
+    def _do_python_keypoint_eval(self, results, res_folder):
+        if self.fast_coco_eval:
+            stats = evaluate_keypoints(
+                self.coco, results, num_workers=self.eval_workers
+            )
+        else:
+            # loadRes accepts the in-memory list of result dicts as well
+            # as a results file name
+            coco_dt = self.coco.loadRes(results)
+            coco_eval = COCOeval(self.coco, coco_dt, 'keypoints')
+            coco_eval.params.useSegm = None
+            coco_eval.evaluate()
+            coco_eval.accumulate()
+            coco_eval.summarize()
+            stats = coco_eval.stats
 
         stats_names = ['AP', 'Ap .5', 'AP .75', 'AP (M)', 'AP (L)', 'AR', 'AR .5', 'AR .75', 'AR (M)', 'AR (L)']
 
         info_str = []
         for ind, name in enumerate(stats_names):
-            info_str.append((name, coco_eval.stats[ind]))
+            info_str.append((name, stats[ind]))
 
         return info_str
@@ -0,0 +1,61 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import torch
+
+
+class DataPrefetcher(object):
+    """
+    Wraps a JointsDataset DataLoader and copies the next batch's input,
+    target and target_weight to the device on a side cuda stream while
+    the current batch is being processed. meta stays on the host.
+    Without a cuda device the batches are passed through unchanged.
+    """
+    def __init__(self, loader, device=None):
+        self.loader = loader
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.device.type != 'cuda':
+            for batch in self.loader:
+                yield batch
+            return
+
+        stream = torch.cuda.Stream(device=self.device)
+        loader_iter = iter(self.loader)
+        next_batch = self._preload(loader_iter, stream)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            # the tensors were allocated on the side stream, keep the
+            # caching allocator from reusing them too early
+            for tensor in batch[:3]:
+                tensor.record_stream(current_stream)
+
+            next_batch = self._preload(loader_iter, stream)
+            yield batch
+
+    def _preload(self, loader_iter, stream):
+        try:
+            input, target, target_weight, meta = next(loader_iter)
+        except StopIteration:
+            return None
+
+        with torch.cuda.stream(stream):
+            input = input.to(self.device, non_blocking=True)
+            target = target.to(self.device, non_blocking=True)
+            target_weight = target_weight.to(self.device, non_blocking=True)
+
+        return input, target, target_weight, meta
@@ -8,16 +8,23 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import inspect
 import os
 import logging
 
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 
 BN_MOMENTUM = 0.1
 logger = logging.getLogger(__name__)
 
+CHECKPOINT_MODES = ('', 'module', 'branch')
+# the non-reentrant variant also works when the inputs do not require grad
+_CHECKPOINT_KWARGS = {'use_reentrant': False} \
+    if 'use_reentrant' in inspect.signature(checkpoint).parameters else {}
+
 
 def conv3x3(in_planes, out_planes, stride=1):
     """3x3 convolution with padding"""
@@ -100,7 +107,8 @@ class Bottleneck(nn.Module):
 
 class HighResolutionModule(nn.Module):
     def __init__(self, num_branches, blocks, num_blocks, num_inchannels,
-                 num_channels, fuse_method, multi_scale_output=True):
+                 num_channels, fuse_method, multi_scale_output=True,
+                 inplace_fuse=False):
         super(HighResolutionModule, self).__init__()
         self._check_branches(
             num_branches, blocks, num_blocks, num_inchannels, num_channels)
@@ -110,6 +118,9 @@ class HighResolutionModule(nn.Module):
         self.num_branches = num_branches
 
         self.multi_scale_output = multi_scale_output
+        self.inplace_fuse = inplace_fuse
+        # activation checkpointing, see PoseHighResolutionNet.set_checkpoint
+        self.checkpoint_mode = ''
 
         self.branches = self._make_branches(
             num_branches, blocks, num_blocks, num_channels)
@@ -244,15 +255,83 @@ class HighResolutionModule(nn.Module):
     def get_num_inchannels(self):
         return self.num_inchannels
 
+    def _add_upsampled(self, y, z, factor, inplace):
+        '''
+        y + nearest upsampled z, without materializing the upsampled z:
+        y is viewed as (N, C, H/f, f, W/f, f) and z is broadcast over the
+        two f axes. y is updated in place if inplace is set
+        '''
+        n, c, h, w = y.shape
+        low_h, low_w = z.shape[-2:]
+        if h != low_h * factor or w != low_w * factor \
+           or not y.is_contiguous():
+            upsampled = nn.functional.interpolate(
+                z, size=(h, w), mode='nearest')
+            return y.add_(upsampled) if inplace else y + upsampled
+
+        y_blocks = y.view(n, c, low_h, factor, low_w, factor)
+        z = z[:, :, :, None, :, None]
+        if inplace:
+            y_blocks.add_(z)
+            return y
+        return torch.add(y_blocks, z).view(n, c, h, w)
+
+    def _fuse_inplace(self, x, i):
+        # y starts as x[i] (shared, must not be written) or as the output
+        # of the first downsampling path (ours); after the first add it
+        # is always a fresh buffer and the rest accumulates in place
+        y = None
+        inplace = False
+        for j in range(self.num_branches):
+            if j > i:
+                up = self.fuse_layers[i][j]
+                z = x[j]
+                # 1x1 conv + bn at the low resolution, the Upsample is
+                # folded into the add
+                for k in range(len(up) - 1):
+                    z = up[k](z)
+                factor = int(up[-1].scale_factor)
+                y = self._add_upsampled(y, z, factor, inplace)
+            else:
+                z = x[j] if j == i else self.fuse_layers[i][j](x[j])
+                if y is None:
+                    y = z
+                    inplace = j != i
+                    continue
+                y = y.add_(z) if inplace else y + z
+            inplace = True
+        return y
+
+    def _run_branch(self, i, x):
+        if self.checkpoint_mode == 'branch' and torch.is_grad_enabled():
+            return checkpoint(self.branches[i], x, **_CHECKPOINT_KWARGS)
+        return self.branches[i](x)
+
+    def _forward_tuple(self, *x):
+        return tuple(self._forward(list(x)))
+
     def forward(self, x):
+        if self.checkpoint_mode == 'module' and torch.is_grad_enabled():
+            # keep only the module inputs, recompute the rest in backward
+            return list(checkpoint(
+                self._forward_tuple, *x, **_CHECKPOINT_KWARGS))
+        return self._forward(x)
+
+    def _forward(self, x):
         if self.num_branches == 1:
-            return [self.branches[0](x[0])]
+            return [self._run_branch(0, x[0])]
 
         for i in range(self.num_branches):
-            x[i] = self.branches[i](x[i])
+            x[i] = self._run_branch(i, x[i])
 
         x_fuse = []
 
+        # the ONNX exporter does not keep in-place writes through views
+        if self.inplace_fuse and not torch.onnx.is_in_onnx_export():
+            for i in range(len(self.fuse_layers)):
+                x_fuse.append(self.relu(self._fuse_inplace(x, i)))
+            return x_fuse
+
         for i in range(len(self.fuse_layers)):
             y = x[0] if i == 0 else self.fuse_layers[i][0](x[0])
             for j in range(1, self.num_branches):
@@ -277,6 +356,7 @@ class PoseHighResolutionNet(nn.Module):
         self.inplanes = 64
         extra = cfg.MODEL.EXTRA
         super(PoseHighResolutionNet, self).__init__()
+        self.inplace_fuse = extra.get('INPLACE_FUSE', False)
 
         # stem net
         self.conv1 = nn.Conv2d(3, 64, kernel_size=3, stride=2, padding=1,
@@ -330,6 +410,34 @@ class PoseHighResolutionNet(nn.Module):
 
         self.pretrained_layers = cfg['MODEL']['EXTRA']['PRETRAINED_LAYERS']
 
+        # plain ints for forward, no config lookups for the compiler to
+        # guard on
+        self.num_branches = [
+            self.stage2_cfg['NUM_BRANCHES'],
+            self.stage3_cfg['NUM_BRANCHES'],
+            self.stage4_cfg['NUM_BRANCHES'],
+        ]
+
+        self.checkpoint_mode = ''
+        self.set_checkpoint(extra.get('CHECKPOINT', ''))
+
+    def set_checkpoint(self, mode):
+        '''
+        recompute activations in backward instead of storing them,
+        per HighResolutionModule ('module'), per branch ('branch') or
+        not at all ('')
+        '''
+        if mode not in CHECKPOINT_MODES:
+            error_msg = 'CHECKPOINT({}) not in {}'.format(
+                mode, CHECKPOINT_MODES)
+            logger.error(error_msg)
+            raise ValueError(error_msg)
+
+        self.checkpoint_mode = mode
+        for m in self.modules():
+            if isinstance(m, HighResolutionModule):
+                m.checkpoint_mode = mode
+
     def _make_transition_layer(
             self, num_channels_pre_layer, num_channels_cur_layer):
         num_branches_cur = len(num_channels_cur_layer)
@@ -415,7 +523,8 @@ class PoseHighResolutionNet(nn.Module):
                     num_inchannels,
                     num_channels,
                     fuse_method,
-                    reset_multi_scale_output
+                    reset_multi_scale_output,
+                    self.inplace_fuse
                 )
             )
             num_inchannels = modules[-1].get_num_inchannels()
@@ -432,7 +541,7 @@ class PoseHighResolutionNet(nn.Module):
         x = self.layer1(x)
 
         x_list = []
-        for i in range(self.stage2_cfg['NUM_BRANCHES']):
+        for i in range(self.num_branches[0]):
             if self.transition1[i] is not None:
                 x_list.append(self.transition1[i](x))
             else:
@@ -440,7 +549,7 @@ class PoseHighResolutionNet(nn.Module):
         y_list = self.stage2(x_list)
 
         x_list = []
-        for i in range(self.stage3_cfg['NUM_BRANCHES']):
+        for i in range(self.num_branches[1]):
             if self.transition2[i] is not None:
                 x_list.append(self.transition2[i](y_list[-1]))
             else:
@@ -448,7 +557,7 @@ class PoseHighResolutionNet(nn.Module):
         y_list = self.stage3(x_list)
 
         x_list = []
-        for i in range(self.stage4_cfg['NUM_BRANCHES']):
+        for i in range(self.num_branches[2]):
             if self.transition3[i] is not None:
                 x_list.append(self.transition3[i](y_list[-1]))
             else:
@@ -0,0 +1,125 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+import logging
+import time
+
+import torch
+
+from utils.fusion import fuse_for_inference
+
+
+logger = logging.getLogger(__name__)
+
+PRECISIONS = {
+    'fp32': torch.float32,
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16,
+}
+
+
+def get_autocast_dtype(precision, device):
+    '''
+    dtype to autocast to on device, None means plain fp32
+    fp16/bf16 are only used on cuda (bf16 if the device supports it),
+    on the cpu everything falls back to fp32
+    '''
+    if precision not in PRECISIONS:
+        raise ValueError('Unknown precision {}, expected one of {}'.format(
+            precision, list(PRECISIONS.keys())))
+
+    device = torch.device(device)
+    if precision == 'fp32' or device.type != 'cuda':
+        return None
+    if precision == 'bf16' and not torch.cuda.is_bf16_supported():
+        return None
+    return PRECISIONS[precision]
+
+
+def autocast(device, dtype=None):
+    '''autocast context for device, does nothing if dtype is None'''
+    if dtype is None:
+        return contextlib.nullcontext()
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(device_type=torch.device(device).type,
+                              dtype=dtype)
+    return torch.cuda.amp.autocast()
+
+
+def get_grad_scaler(config, device):
+    '''
+    GradScaler for TRAIN.PRECISION fp16 on cuda, None when the loss does
+    not need scaling (fp32 and bf16)
+    '''
+    if get_autocast_dtype(config.TRAIN.PRECISION, device) != torch.float16:
+        return None
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda')
+    return torch.cuda.amp.GradScaler()
+
+
+def get_memory_format(config):
+    return torch.channels_last if config.TEST.CHANNELS_LAST \
+        else torch.contiguous_format
+
+
+def prepare_inference_model(config, model, device):
+    '''
+    apply the TEST.FUSE_BN / TEST.CHANNELS_LAST / TEST.PRECISION inference
+    mode to an eval model, the autocast itself happens around the forward
+    calls
+    '''
+    if config.TEST.FUSE_BN:
+        model = fuse_for_inference(model)
+
+    dtype = get_autocast_dtype(config.TEST.PRECISION, device)
+    if dtype is None and config.TEST.PRECISION != 'fp32':
+        logger.info('=> {} is not supported on {}, running in fp32'.format(
+            config.TEST.PRECISION, device))
+
+    model = model.to(device, memory_format=get_memory_format(config))
+    logger.info('=> inference mode: {}, {}'.format(
+        dtype if dtype is not None else torch.float32,
+        'channels_last' if config.TEST.CHANNELS_LAST else 'contiguous'))
+    return model
+
+
+def inference_forward(config, model, input, device):
+    '''heatmaps of model(input) in fp32, run in the TEST.PRECISION mode'''
+    with autocast(device, get_autocast_dtype(config.TEST.PRECISION, device)):
+        outputs = model(input)
+    if isinstance(outputs, list):
+        outputs = outputs[-1]
+    return outputs.float()
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def measure_latency(config, model, inputs, device, warmup, iters):
+    '''
+    :return: milliseconds per batch, heatmaps of the last pass
+    '''
+    inputs = inputs.to(device).contiguous(
+        memory_format=get_memory_format(config))
+    with torch.no_grad():
+        for _ in range(warmup):
+            output = inference_forward(config, model, inputs, device)
+        synchronize(device)
+
+        start = time.perf_counter()
+        for _ in range(iters):
+            output = inference_forward(config, model, inputs, device)
+        synchronize(device)
+        elapsed = time.perf_counter() - start
+
+    return elapsed / iters * 1000, output
@@ -0,0 +1,311 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+import glob
+import logging
+import os
+import random
+import shutil
+import threading
+import time
+
+import numpy as np
+import torch
+
+from utils.distributed import broadcast_object
+from utils.distributed import gather_object
+from utils.distributed import get_rank
+from utils.distributed import get_world_size
+from utils.distributed import is_main_process
+from utils.utils import save_checkpoint
+
+
+logger = logging.getLogger(__name__)
+
+
+def set_seed(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def get_rng_state():
+    # the numpy key as a tensor, so torch.load works with weights_only
+    name, key, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {
+        'python': random.getstate(),
+        'numpy': (name, torch.from_numpy(key.astype(np.int64)), int(pos),
+                  int(has_gauss), float(cached_gaussian)),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    name, key, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, key.cpu().numpy().astype(np.uint32), pos,
+                         has_gauss, cached_gaussian))
+    # loaded checkpoints may have been mapped to the gpu
+    torch.set_rng_state(state['torch'].cpu())
+    if 'cuda' in state and torch.cuda.is_available() \
+            and len(state['cuda']) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
+
+
+def _link_or_copy(src, dst):
+    '''
+    atomically point dst at the file src, a copy if hard links fail
+    '''
+    tmp_dst = '{}.tmp{}'.format(dst, os.getpid())
+    if os.path.exists(tmp_dst):
+        os.remove(tmp_dst)
+    try:
+        os.link(src, tmp_dst)
+    except OSError:
+        shutil.copyfile(src, tmp_dst)
+    os.replace(tmp_dst, dst)
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints for Checkpointer. With TRAIN.ASYNC_CHECKPOINT a
+    background thread writes from a cpu snapshot (pinned for gpu tensors,
+    the buffers are reused by the next snapshot), so the training only
+    waits for the device to host copy. Tensors shared between entries, e.g.
+    state_dict and best_state_dict, are copied and serialized once. With
+    TRAIN.KEEP_LAST_CHECKPOINTS > 0 every checkpoint is kept as
+    checkpoint_e<epoch>_i<iteration>.pth, checkpoint.pth links to the
+    latest and only the last ones are kept. model_best.pth is only
+    replaced by a better model.
+    """
+    def __init__(self, output_dir, async_write=False, keep_last=0):
+        self.output_dir = output_dir
+        self.async_write = async_write
+        self.keep_last = keep_last
+        self.buffers = {}
+        self.thread = None
+        self.error = None
+
+    def write(self, state, is_best, epoch, iteration):
+        self.wait()
+        if not self.async_write:
+            self._write(state, is_best, epoch, iteration)
+            return
+
+        start = time.time()
+        state = self._snapshot(state)
+        logger.info('=> checkpoint snapshot took {:.3f}s'.format(
+            time.time() - start))
+        self.thread = threading.Thread(
+            target=self._run, args=(state, is_best, epoch, iteration))
+        self.thread.start()
+
+    def wait(self):
+        '''
+        block until the last checkpoint is written, raises its error
+        '''
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self, state, is_best, epoch, iteration):
+        try:
+            self._write(state, is_best, epoch, iteration)
+        except Exception as e:
+            self.error = e
+
+    def _write(self, state, is_best, epoch, iteration):
+        start = time.time()
+        checkpoint_file = os.path.join(self.output_dir, 'checkpoint.pth')
+        if self.keep_last > 0:
+            filename = 'checkpoint_e{:03d}_i{:06d}.pth'.format(
+                epoch, iteration)
+            save_checkpoint(state, is_best, self.output_dir, filename)
+            _link_or_copy(
+                os.path.join(self.output_dir, filename), checkpoint_file)
+            # the names sort by epoch and iteration
+            old_files = sorted(glob.glob(os.path.join(
+                self.output_dir, 'checkpoint_e*_i*.pth')))[:-self.keep_last]
+            for old_file in old_files:
+                os.remove(old_file)
+        else:
+            save_checkpoint(state, is_best, self.output_dir)
+        logger.info('=> checkpoint written in {:.3f}s'.format(
+            time.time() - start))
+
+    def _snapshot(self, state):
+        buffers = {}
+        snapshot = self._copy(state, buffers)
+        if any(buffer.is_pinned() for buffer in buffers.values()):
+            # the copies from the gpu are non blocking
+            torch.cuda.synchronize()
+        self.buffers = buffers
+        return snapshot
+
+    def _copy(self, obj, buffers):
+        if torch.is_tensor(obj):
+            key = (obj.data_ptr(), obj.dtype, obj.shape, obj.stride(),
+                   obj.device)
+            if key not in buffers:
+                buffer = self.buffers.get(key)
+                if buffer is None:
+                    buffer = torch.empty_like(
+                        obj, device='cpu', pin_memory=obj.is_cuda)
+                buffers[key] = buffer.copy_(obj.detach(), non_blocking=True)
+            return buffers[key]
+        if isinstance(obj, dict):
+            # keeps the _metadata of state dicts
+            copied = copy.copy(obj)
+            for k, v in obj.items():
+                copied[k] = self._copy(v, buffers)
+            return copied
+        if type(obj) in (list, tuple):
+            return type(obj)(self._copy(v, buffers) for v in obj)
+        return copy.deepcopy(obj)
+
+
+class Checkpointer(object):
+    """
+    Saves the full training state to output_dir/checkpoint.pth: model,
+    optimizer, lr scheduler, grad scaler, the rng states of every rank,
+    the sampler seed with the position in the epoch, the tensorboard steps
+    and the perf. Besides the end of every epoch it saves every
+    TRAIN.CHECKPOINT_STEPS optimizer steps or TRAIN.CHECKPOINT_SECS seconds
+    (checked every PRINT_FREQ steps), so a preempted run resumes in the
+    middle of its epoch. Saving gathers the rng states, every rank has to
+    take part, only rank 0 writes (with CheckpointWriter).
+    """
+    def __init__(self, config, output_dir, model, optimizer, lr_scheduler,
+                 scaler, sampler, writer_dict):
+        self.output_dir = output_dir
+        self.model_name = config.MODEL.NAME
+        self.every_steps = config.TRAIN.CHECKPOINT_STEPS
+        self.every_secs = config.TRAIN.CHECKPOINT_SECS
+        # the clock is only checked every PRINT_FREQ optimizer steps, in
+        # distributed runs that check is a collective
+        self.check_every = max(config.PRINT_FREQ, 1)
+        self.model = model
+        self.optimizer = optimizer
+        self.lr_scheduler = lr_scheduler
+        self.scaler = scaler
+        self.sampler = sampler
+        self.writer_dict = writer_dict
+        self.writer = CheckpointWriter(
+            output_dir, config.TRAIN.ASYNC_CHECKPOINT,
+            config.TRAIN.KEEP_LAST_CHECKPOINTS)
+
+        # set by train.py after every validation
+        self.perf = 0.0
+        self.best_perf = 0.0
+        # epoch whose background evaluation was still running at the
+        # epoch end save, a resumed run evaluates it again
+        self.pending_eval = None
+        # called before the saves within an epoch, e.g. to wait for the
+        # background evaluation
+        self.before_save = None
+
+        self.num_steps = 0
+        self.last_save = time.time()
+
+    def state(self, epoch, iteration):
+        '''
+        :return: the checkpoint on rank 0, None on the other ranks
+        '''
+        rng_states = gather_object(get_rng_state())
+        if not is_main_process():
+            return None
+
+        writer_steps = None
+        if self.writer_dict:
+            writer_steps = {
+                'train_global_steps': self.writer_dict['train_global_steps'],
+                'valid_global_steps': self.writer_dict['valid_global_steps'],
+            }
+        return {
+            'epoch': epoch,
+            'iteration': iteration,
+            'model': self.model_name,
+            'state_dict': self.model.state_dict(),
+            'best_state_dict': self.model.module.state_dict(),
+            'perf': float(self.perf),
+            'best_perf': float(self.best_perf),
+            'optimizer': self.optimizer.state_dict(),
+            'lr_scheduler': self.lr_scheduler.state_dict(),
+            'scaler': self.scaler.state_dict()
+            if self.scaler is not None else None,
+            'pending_eval': self.pending_eval,
+            'seed': self.sampler.seed,
+            'rng': rng_states,
+            'writer_steps': writer_steps,
+        }
+
+    def save(self, epoch, iteration=0, is_best=False):
+        '''
+        :param epoch: the epoch to resume, the next one at its end
+        :param iteration: batches of that epoch already trained on
+        '''
+        state = self.state(epoch, iteration)
+        if state is not None:
+            logger.info('=> saving checkpoint to {} (epoch {}, iteration {})'
+                        .format(self.output_dir, epoch, iteration))
+            self.writer.write(state, is_best, epoch, iteration)
+        self.last_save = time.time()
+
+    def close(self):
+        '''
+        wait for the checkpoint being written
+        '''
+        self.writer.wait()
+
+    def step(self, epoch, iteration):
+        '''
+        called after every optimizer step, saves when one is due
+        '''
+        self.num_steps += 1
+        due = self.every_steps > 0 and self.num_steps % self.every_steps == 0
+        if not due and self.every_secs > 0 \
+                and self.num_steps % self.check_every == 0:
+            # the clocks of the ranks differ, rank 0 decides for all
+            due = broadcast_object(
+                time.time() - self.last_save >= self.every_secs)
+        if due:
+            if self.before_save is not None:
+                self.before_save()
+            self.save(epoch, iteration)
+
+    def load(self, checkpoint):
+        '''
+        restores the perf, the pending evaluation, the sampler seed, the
+        tensorboard steps and the rng state of this rank, the model,
+        optimizer, lr scheduler and grad scaler are loaded by the caller
+        :return: epoch and iteration to resume from
+        '''
+        self.perf = checkpoint['perf']
+        self.best_perf = checkpoint.get('best_perf', checkpoint['perf'])
+        self.pending_eval = checkpoint.get('pending_eval')
+        if checkpoint.get('seed') is not None:
+            self.sampler.seed = checkpoint['seed']
+        if self.writer_dict and checkpoint.get('writer_steps'):
+            self.writer_dict.update(checkpoint['writer_steps'])
+
+        rng_states = checkpoint.get('rng')
+        if rng_states is not None and len(rng_states) == get_world_size():
+            set_rng_state(rng_states[get_rank()])
+        elif rng_states is not None:
+            logger.warning('=> the rng states of {} ranks are not restored '
+                           'in a run of {}'.format(
+                               len(rng_states), get_world_size()))
+        return checkpoint['epoch'], checkpoint.get('iteration', 0)
@@ -0,0 +1,115 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import time
+
+import torch
+import torch.nn as nn
+
+from utils.utils import get_model_device
+
+
+logger = logging.getLogger(__name__)
+
+
+def _time_forward(forward, input, iters):
+    device = input.device
+    with torch.no_grad():
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        for _ in range(iters):
+            forward(input)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def audit_compile(model, input, iters=10):
+    '''
+    log the graph breaks torch.compile hits in model.forward, and the
+    eager vs compiled forward time on input (eval mode, no grad)
+    :param model: module after compile_model, DistributedDataParallel and
+                  DataParallel are audited on the module they wrap
+    '''
+    module = model
+    if isinstance(model, (nn.DataParallel,
+                          nn.parallel.DistributedDataParallel)):
+        # a DDP forward with grad would wait for a backward
+        module = model.module
+    training = model.training
+    model.eval()
+    try:
+        _audit(model, module, input, iters)
+    finally:
+        model.train(training)
+
+
+def _audit(model, module, input, iters):
+    def eager(x):
+        # bypasses __call__ and with it the compiled forward
+        return type(module).forward(module, x)
+
+    with torch.no_grad():
+        explanation = torch._dynamo.explain(eager)(input)
+    logger.info('=> torch.compile audit: {} graph(s), {} graph break(s), '
+                '{} ops'.format(explanation.graph_count,
+                                explanation.graph_break_count,
+                                explanation.op_count))
+    for reason in explanation.break_reasons:
+        logger.info('=> graph break: {}'.format(reason.reason))
+
+    start = time.perf_counter()
+    with torch.no_grad():
+        model(input)
+    compile_time = time.perf_counter() - start
+
+    eager_time = _time_forward(eager, input, iters)
+    compiled_time = _time_forward(model, input, iters)
+    logger.info('=> forward batch {}: eager {:.2f}ms, compiled {:.2f}ms '
+                '({:.2f}x), first compiled call {:.1f}s'.format(
+                    input.size(0), eager_time, compiled_time,
+                    eager_time / compiled_time, compile_time))
+
+
+def compile_model(config, model, example_input=None):
+    '''
+    compile model (or the module inside a single device DataParallel) in
+    place when COMPILE.ENABLED, the state_dict keys do not change
+    :param example_input: audited with when COMPILE.AUDIT is set
+    '''
+    if not config.COMPILE.ENABLED:
+        return model
+    if not hasattr(torch, 'compile'):
+        logger.warning('=> torch.compile needs torch 2.0, running eager')
+        return model
+
+    module = model
+    if isinstance(model, nn.DataParallel):
+        # the replicas would all call the compiled forward of device 0
+        if len(model.device_ids) > 1:
+            logger.warning('=> torch.compile is skipped for DataParallel '
+                           'on {} devices'.format(len(model.device_ids)))
+            return model
+        module = model.module
+
+    logger.info('=> compiling {} (mode: {}, backend: {})'.format(
+        module.__class__.__name__, config.COMPILE.MODE,
+        config.COMPILE.BACKEND))
+    kwargs = {'mode': config.COMPILE.MODE, 'backend': config.COMPILE.BACKEND}
+    if hasattr(module, 'compile'):
+        module.compile(**kwargs)
+    else:
+        module.forward = torch.compile(module.forward, **kwargs)
+
+    if config.COMPILE.AUDIT and example_input is not None:
+        audit_compile(module, example_input.to(get_model_device(module)))
+
+    return model
@@ -0,0 +1,190 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from collections import OrderedDict
+import logging
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.utils.data import Sampler
+from torch.utils.data.distributed import DistributedSampler
+
+
+logger = logging.getLogger(__name__)
+
+
+def init_distributed(config):
+    '''
+    join the process group when launched with torchrun (one process per
+    device, RANK / WORLD_SIZE / LOCAL_RANK in the environment) and set
+    config.RANK
+    :return: True when running distributed
+    '''
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size <= 1:
+        return False
+
+    rank = int(os.environ['RANK'])
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    backend = config.DIST_BACKEND or \
+        ('nccl' if torch.cuda.is_available() else 'gloo')
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+    dist.init_process_group(backend=backend, init_method='env://')
+
+    config.defrost()
+    config.RANK = rank
+    config.freeze()
+    return True
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def get_device(config):
+    '''
+    the device of this process, LOCAL_RANK when distributed and the
+    first of GPUS otherwise
+    '''
+    if not torch.cuda.is_available():
+        return torch.device('cpu')
+    if is_distributed():
+        return torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)))
+    return torch.device('cuda', config.GPUS[0])
+
+
+def broadcast_object(obj):
+    '''
+    :return: obj of rank 0 on every rank
+    '''
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=0)
+    return objects[0]
+
+
+def gather_object(obj):
+    '''
+    :return: the list of obj of every rank on rank 0, None on the other ranks
+    '''
+    if not is_distributed():
+        return [obj]
+    gathered = [None] * get_world_size() if is_main_process() else None
+    dist.gather_object(obj, gathered, dst=0)
+    return gathered
+
+
+def gather_arrays(*arrays):
+    '''
+    concatenate the arrays (or lists) of every rank along the first axis,
+    in rank order
+    :return: the concatenated arrays on rank 0, None on the other ranks
+    '''
+    if not is_distributed():
+        return arrays
+    gathered = [None] * get_world_size() if is_main_process() else None
+    dist.gather_object(arrays, gathered, dst=0)
+    if not is_main_process():
+        return None
+    return tuple(
+        np.concatenate([shard[k] for shard in gathered])
+        if isinstance(arrays[k], np.ndarray)
+        else sum([list(shard[k]) for shard in gathered], [])
+        for k in range(len(arrays))
+    )
+
+
+def _image_groups(dataset):
+    '''
+    indices of the samples of each image, in order of first appearance
+    '''
+    db = getattr(dataset, 'db', None)
+    if db is None:
+        return [[i] for i in range(len(dataset))]
+    groups = OrderedDict()
+    for i, rec in enumerate(db):
+        groups.setdefault(rec['image'], []).append(i)
+    return list(groups.values())
+
+
+class ShardSampler(Sampler):
+    """
+    A shard of the dataset for each rank that keeps all boxes of an image
+    on the same rank, so the per image rescoring and oks nms see all of
+    them. The shards are contiguous runs of images with about the same
+    number of boxes. Unlike DistributedSampler no sample is repeated, so
+    the shards of all ranks evaluate every sample exactly once.
+    """
+    def __init__(self, dataset, num_replicas=None, rank=None):
+        self.num_replicas = get_world_size() \
+            if num_replicas is None else num_replicas
+        self.rank = get_rank() if rank is None else rank
+
+        groups = _image_groups(dataset)
+        # split at the image boundaries closest to equal sized shards
+        ends = np.cumsum([0] + [len(group) for group in groups])
+        targets = np.linspace(0, len(dataset), self.num_replicas + 1)
+        bounds = [int(np.abs(ends - target).argmin()) for target in targets]
+        self.indices = [
+            i for group in groups[bounds[self.rank]:bounds[self.rank + 1]]
+            for i in group
+        ]
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class ResumableSampler(DistributedSampler):
+    """
+    The training sampler of every run, distributed or not. The order of an
+    epoch only depends on the seed and the epoch, so a resumed run can
+    skip the samples it already trained on with set_start.
+    """
+    def __init__(self, dataset, shuffle=True, seed=0):
+        super(ResumableSampler, self).__init__(
+            dataset, num_replicas=get_world_size(), rank=get_rank(),
+            shuffle=shuffle, seed=seed)
+        self.start = 0
+
+    def set_start(self, start):
+        '''
+        :param start: samples of this rank to skip, set every epoch
+        '''
+        self.start = min(start, self.num_samples)
+
+    def __iter__(self):
+        indices = list(super(ResumableSampler, self).__iter__())
+        return iter(indices[self.start:])
+
+    def __len__(self):
+        return self.num_samples - self.start
@@ -0,0 +1,78 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import os
+
+import torch
+import torch.nn as nn
+
+
+logger = logging.getLogger(__name__)
+
+
+class TorchScriptModel(nn.Module):
+    """
+    traced model written by tools/export.py, frozen for the device it
+    is loaded on
+    """
+    def __init__(self, path, device):
+        super(TorchScriptModel, self).__init__()
+        model = torch.jit.load(path, map_location=device).eval()
+        model = torch.jit.freeze(model)
+        if hasattr(torch.jit, 'optimize_for_inference'):
+            model = torch.jit.optimize_for_inference(model)
+        self.model = model
+        # the frozen graph has no parameters left, this tells
+        # get_model_device where the inputs have to go
+        self.register_buffer(
+            'device_anchor', torch.empty(0, device=device), persistent=False)
+
+    def forward(self, x):
+        return self.model(x)
+
+
+class OnnxModel(nn.Module):
+    """
+    onnxruntime session behind the nn.Module interface used by validate
+    and demo.py, inputs and outputs are torch tensors
+    """
+    def __init__(self, path, device):
+        super(OnnxModel, self).__init__()
+        import onnxruntime
+
+        providers = ['CPUExecutionProvider']
+        if device.type == 'cuda':
+            providers.insert(0, 'CUDAExecutionProvider')
+        self.session = onnxruntime.InferenceSession(path, providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+        self.register_buffer(
+            'device_anchor', torch.empty(0, device=device), persistent=False)
+
+    def forward(self, x):
+        output = self.session.run(
+            None, {self.input_name: x.detach().float().cpu().numpy()})[0]
+        return torch.from_numpy(output).to(x.device)
+
+
+def load_exported_model(path, device):
+    '''
+    :param path: .pt (TorchScript) or .onnx file from tools/export.py
+    :return: eval module returning the heatmaps
+    '''
+    device = torch.device(device)
+    ext = os.path.splitext(path)[1]
+    logger.info('=> loading exported model from {}'.format(path))
+    if ext == '.onnx':
+        model = OnnxModel(path, device)
+    elif ext in ('.pt', '.pth'):
+        model = TorchScriptModel(path, device)
+    else:
+        raise ValueError('Unknown exported model format: {}'.format(path))
+    return model.eval()
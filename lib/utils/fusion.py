@@ -0,0 +1,140 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+import logging
+
+import torch
+import torch.nn as nn
+
+
+logger = logging.getLogger(__name__)
+
+_CONVS = (nn.Conv2d, nn.ConvTranspose2d)
+
+
+def fuse_conv_bn(conv, bn):
+    '''
+    fold the running statistics and affine parameters of bn into conv,
+    in place, conv gets a bias if it had none
+    '''
+    if isinstance(conv, nn.ConvTranspose2d) and conv.groups != 1:
+        raise ValueError('grouped ConvTranspose2d can not be fused')
+
+    with torch.no_grad():
+        scale = bn.running_var.add(bn.eps).rsqrt()
+        if bn.affine:
+            shift = bn.bias - bn.running_mean * bn.weight * scale
+            scale = scale * bn.weight
+        else:
+            shift = -bn.running_mean * scale
+
+        # out channels are dim 0 of a conv weight, dim 1 of a deconv weight
+        if isinstance(conv, nn.ConvTranspose2d):
+            conv.weight.mul_(scale.view(1, -1, 1, 1))
+        else:
+            conv.weight.mul_(scale.view(-1, 1, 1, 1))
+
+        if conv.bias is None:
+            conv.bias = nn.Parameter(shift.clone())
+        else:
+            conv.bias.mul_(scale).add_(shift)
+
+    return conv
+
+
+def _conv_bn_pairs(module):
+    '''
+    (parent, bn name, conv) triples of the BN layers that directly follow
+    a conv: consecutive children of a Sequential, and the convN / bnN
+    attributes of the residual blocks
+    '''
+    pairs = []
+    for parent in module.modules():
+        if isinstance(parent, nn.Sequential):
+            children = list(parent.named_children())
+            for (_, conv), (name, bn) in zip(children[:-1], children[1:]):
+                if isinstance(conv, _CONVS) and isinstance(bn, nn.BatchNorm2d):
+                    pairs.append((parent, name, conv))
+        else:
+            for i in range(1, 4):
+                conv = getattr(parent, 'conv{}'.format(i), None)
+                bn = getattr(parent, 'bn{}'.format(i), None)
+                if isinstance(conv, _CONVS) and isinstance(bn, nn.BatchNorm2d):
+                    pairs.append((parent, 'bn{}'.format(i), conv))
+    return pairs
+
+
+def fuse_for_inference(model):
+    '''
+    returns an eval-only copy of model with every BatchNorm2d folded into
+    the conv / deconv in front of it and replaced by nn.Identity, the
+    module names stay the same so forward() needs no change
+    '''
+    fused = copy.deepcopy(model)
+    fused.eval()
+
+    pairs = _conv_bn_pairs(fused)
+    for parent, name, conv in pairs:
+        fuse_conv_bn(conv, getattr(parent, name))
+        setattr(parent, name, nn.Identity())
+
+    remaining = sum(
+        1 for m in fused.modules() if isinstance(m, nn.BatchNorm2d)
+    )
+    logger.info('=> fused {} BatchNorm layers, {} left unfused'.format(
+        len(pairs), remaining))
+    return fused
+
+
+def _randomize_bn(model):
+    # freshly initialized BN is the identity, give it something to fold
+    generator = torch.Generator().manual_seed(0)
+    for m in model.modules():
+        if isinstance(m, nn.BatchNorm2d):
+            m.running_mean.copy_(
+                torch.randn(m.num_features, generator=generator) * 0.1)
+            m.running_var.copy_(
+                torch.rand(m.num_features, generator=generator) + 0.5)
+            m.weight.data.copy_(
+                torch.rand(m.num_features, generator=generator) + 0.5)
+            m.bias.data.copy_(
+                torch.randn(m.num_features, generator=generator) * 0.1)
+
+
+if __name__ == '__main__':
+    # numerical equivalence check of the fused models:
+    #   cd lib && python -m utils.fusion
+    import os
+    from config import cfg
+    import models
+
+    experiments = os.path.join(
+        os.path.dirname(__file__), '..', '..', 'experiments')
+    for cfg_file in ['coco/hrnet/w32_256x192_adam_lr1e-3.yaml',
+                     'coco/resnet/res50_256x192_d256x3_adam_lr1e-3.yaml']:
+        config = cfg.clone()
+        config.merge_from_file(os.path.join(experiments, cfg_file))
+        model = eval('models.'+config.MODEL.NAME+'.get_pose_net')(
+            config, is_train=False
+        )
+        _randomize_bn(model)
+        model.eval()
+        fused = fuse_for_inference(model)
+
+        input = torch.randn(
+            2, 3, config.MODEL.IMAGE_SIZE[1], config.MODEL.IMAGE_SIZE[0])
+        with torch.no_grad():
+            expected = model(input)
+            output = fused(input)
+        max_diff = (output - expected).abs().max().item()
+        scale = expected.abs().max().item()
+        print('{}: max abs diff {:.3e} (output scale {:.3e})'.format(
+            cfg_file, max_diff, scale))
+        assert torch.allclose(output, expected, rtol=1e-4, atol=1e-5 * scale)
@@ -0,0 +1,192 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from collections import defaultdict
+import logging
+
+import torch
+import torch.nn as nn
+
+from models.pose_hrnet import BasicBlock
+from models.pose_hrnet import PoseHighResolutionNet
+
+
+logger = logging.getLogger(__name__)
+
+STAGES = ['STAGE2', 'STAGE3', 'STAGE4']
+
+
+class _ChannelSpaces(object):
+    """
+    which channel space the output / input channels of every conv and
+    BN belong to. Branch b of every stage shares one 'stream' space
+    (residuals, identity transitions and fuse sums all add into it), the
+    inner channels of each block and of the fuse downsampling chains are
+    spaces of their own. None is a space that is not pruned (stem,
+    layer1, heatmaps).
+    """
+    def __init__(self):
+        # module name -> (out space, in space)
+        self.modules = {}
+        # space -> branch whose width it takes
+        self.branch = {}
+
+    def stream(self, b):
+        space = 'stream{}'.format(b)
+        self.branch[space] = b
+        return space
+
+    def inner(self, name, b):
+        self.branch[name] = b
+        return name
+
+    def conv_bn(self, prefix, conv, bn, out_space, in_space):
+        self.modules['{}.{}'.format(prefix, conv)] = (out_space, in_space)
+        self.modules['{}.{}'.format(prefix, bn)] = (out_space, None)
+
+
+def _transition_spaces(spaces, name, transition, pre_spaces, num_branches):
+    for i in range(num_branches):
+        layer = transition[i]
+        if layer is None:
+            continue
+        prefix = '{}.{}'.format(name, i)
+        if i < len(pre_spaces):
+            spaces.conv_bn(prefix, 0, 1, spaces.stream(i), pre_spaces[i])
+            continue
+        in_space = pre_spaces[-1]
+        for j in range(len(layer)):
+            if j == len(layer) - 1:
+                out_space = spaces.stream(i)
+            elif in_space is None:
+                out_space = None
+            else:
+                out_space = spaces.inner(
+                    '{}.{}'.format(prefix, j), spaces.branch[in_space])
+            spaces.conv_bn('{}.{}'.format(prefix, j), 0, 1,
+                           out_space, in_space)
+            in_space = out_space
+
+
+def _module_spaces(spaces, name, module):
+    for b, branch in enumerate(module.branches):
+        for k, block in enumerate(branch):
+            if type(block) is not BasicBlock:
+                raise ValueError('only BASIC stages can be pruned')
+            prefix = '{}.branches.{}.{}'.format(name, b, k)
+            inner = spaces.inner(prefix, b)
+            spaces.conv_bn(prefix, 'conv1', 'bn1', inner, spaces.stream(b))
+            spaces.conv_bn(prefix, 'conv2', 'bn2', spaces.stream(b), inner)
+            if block.downsample is not None:
+                spaces.conv_bn(prefix + '.downsample', 0, 1,
+                               spaces.stream(b), spaces.stream(b))
+
+    if module.fuse_layers is None:
+        return
+    for i, fuse_layer in enumerate(module.fuse_layers):
+        for j, layer in enumerate(fuse_layer):
+            prefix = '{}.fuse_layers.{}.{}'.format(name, i, j)
+            if j > i:
+                spaces.conv_bn(prefix, 0, 1, spaces.stream(i),
+                               spaces.stream(j))
+            elif j < i:
+                in_space = spaces.stream(j)
+                for k in range(len(layer)):
+                    out_space = spaces.stream(i) if k == len(layer) - 1 \
+                        else spaces.inner('{}.{}'.format(prefix, k), j)
+                    spaces.conv_bn('{}.{}'.format(prefix, k), 0, 1,
+                                   out_space, in_space)
+                    in_space = out_space
+
+
+def get_channel_spaces(model):
+    if not isinstance(model, PoseHighResolutionNet):
+        raise ValueError('{} can not be pruned, only pose_hrnet'.format(
+            model.__class__.__name__))
+
+    spaces = _ChannelSpaces()
+    pre_spaces = [None]
+    for s in range(3):
+        num_branches = model.num_branches[s]
+        _transition_spaces(
+            spaces, 'transition{}'.format(s + 1),
+            getattr(model, 'transition{}'.format(s + 1)),
+            pre_spaces, num_branches)
+        for m, module in enumerate(getattr(model, 'stage{}'.format(s + 2))):
+            _module_spaces(spaces, 'stage{}.{}'.format(s + 2, m), module)
+        pre_spaces = [spaces.stream(b) for b in range(num_branches)]
+    spaces.modules['final_layer'] = (None, spaces.stream(0))
+
+    return spaces
+
+
+def score_channels(model, spaces):
+    '''
+    BN |gamma| per channel space, each BN normalized by its mean so that
+    no single layer dominates a shared stream
+    '''
+    modules = dict(model.named_modules())
+    scores = defaultdict(float)
+    for name, (out_space, _) in spaces.modules.items():
+        module = modules[name]
+        if out_space is None or not isinstance(module, nn.BatchNorm2d):
+            continue
+        gamma = module.weight.detach().abs().float()
+        scores[out_space] = scores[out_space] + gamma / gamma.mean().clamp(
+            min=1e-12)
+    return scores
+
+
+def get_pruned_widths(config, width):
+    '''
+    NUM_CHANNELS of each stage scaled so that branch 0 gets width
+    '''
+    base = config.MODEL.EXTRA.STAGE2.NUM_CHANNELS[0]
+    return {
+        stage: [
+            max(1, int(round(c * width / base)))
+            for c in config.MODEL.EXTRA[stage].NUM_CHANNELS
+        ]
+        for stage in STAGES
+    }
+
+
+def prune_state_dict(model, config, width):
+    '''
+    :return: NUM_CHANNELS per stage, state_dict of the pruned model that
+             get_pose_net builds from them
+    '''
+    spaces = get_channel_spaces(model)
+    widths = get_pruned_widths(config, width)
+    branch_widths = widths['STAGE4']
+    for stage in STAGES:
+        for b, c in enumerate(widths[stage]):
+            if c != branch_widths[b]:
+                raise ValueError('NUM_CHANNELS of branch {} differs between '
+                                 'stages'.format(b))
+
+    keep = {}
+    for space, score in score_channels(model, spaces).items():
+        n = branch_widths[spaces.branch[space]]
+        keep[space] = torch.sort(torch.topk(score, n).indices).values
+        if space.startswith('stream'):
+            logger.info('=> branch {}: keeping {} of {} channels'.format(
+                spaces.branch[space], n, len(score)))
+
+    state_dict = {}
+    for name, tensor in model.state_dict().items():
+        module_name, _ = name.rsplit('.', 1)
+        out_space, in_space = spaces.modules.get(module_name, (None, None))
+        if out_space is not None and tensor.dim() > 0:
+            tensor = tensor.index_select(0, keep[out_space])
+        if in_space is not None and tensor.dim() > 1:
+            tensor = tensor.index_select(1, keep[in_space])
+        state_dict[name] = tensor.clone()
+
+    return widths, state_dict
@@ -0,0 +1,178 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+
+import torch
+import torch.nn as nn
+
+from models.pose_hrnet import BasicBlock
+from models.pose_hrnet import Bottleneck
+from models.pose_hrnet import HighResolutionModule
+from models.pose_hrnet import PoseHighResolutionNet
+from utils.fusion import fuse_for_inference
+
+try:
+    from torch.ao import quantization
+except ImportError:
+    from torch import quantization
+
+
+logger = logging.getLogger(__name__)
+
+
+class QuantizableBasicBlock(BasicBlock):
+    def _init_quantizable(self):
+        self.skip_add = nn.quantized.FloatFunctional()
+
+    def forward(self, x):
+        residual = x
+
+        out = self.conv1(x)
+        out = self.bn1(out)
+        out = self.relu(out)
+
+        out = self.conv2(out)
+        out = self.bn2(out)
+
+        if self.downsample is not None:
+            residual = self.downsample(x)
+
+        return self.skip_add.add_relu(out, residual)
+
+
+class QuantizableBottleneck(Bottleneck):
+    def _init_quantizable(self):
+        self.skip_add = nn.quantized.FloatFunctional()
+
+    def forward(self, x):
+        residual = x
+
+        out = self.conv1(x)
+        out = self.bn1(out)
+        out = self.relu(out)
+
+        out = self.conv2(out)
+        out = self.bn2(out)
+        out = self.relu(out)
+
+        out = self.conv3(out)
+        out = self.bn3(out)
+
+        if self.downsample is not None:
+            residual = self.downsample(x)
+
+        return self.skip_add.add_relu(out, residual)
+
+
+class QuantizableHighResolutionModule(HighResolutionModule):
+    def _init_quantizable(self):
+        # the quantized path has its own adds, no in-place views
+        self.inplace_fuse = False
+        self.checkpoint_mode = ''
+        if self.fuse_layers is None:
+            self.fuse_adds = None
+            return
+        # one observer per add, the partial sums have different ranges
+        self.fuse_adds = nn.ModuleList([
+            nn.ModuleList([
+                nn.quantized.FloatFunctional()
+                for _ in range(self.num_branches - 1)
+            ])
+            for _ in range(len(self.fuse_layers))
+        ])
+
+    def _forward(self, x):
+        if self.num_branches == 1:
+            return [self.branches[0](x[0])]
+
+        for i in range(self.num_branches):
+            x[i] = self.branches[i](x[i])
+
+        x_fuse = []
+
+        for i in range(len(self.fuse_layers)):
+            y = x[0] if i == 0 else self.fuse_layers[i][0](x[0])
+            for j in range(1, self.num_branches):
+                z = x[j] if i == j else self.fuse_layers[i][j](x[j])
+                y = self.fuse_adds[i][j - 1].add(y, z)
+            x_fuse.append(self.relu(y))
+
+        return x_fuse
+
+
+_QUANTIZABLE = [
+    (BasicBlock, QuantizableBasicBlock),
+    (Bottleneck, QuantizableBottleneck),
+    (HighResolutionModule, QuantizableHighResolutionModule),
+]
+
+
+class QuantizablePoseNet(nn.Module):
+    """
+    quant / dequant stubs around a pose model, the input and the
+    heatmaps stay float
+    """
+    def __init__(self, model):
+        super(QuantizablePoseNet, self).__init__()
+        self.quant = quantization.QuantStub()
+        self.model = model
+        self.dequant = quantization.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.model(self.quant(x)))
+
+
+def prepare_quantizable(model):
+    '''
+    float copy of a PoseHighResolutionNet that eager mode quantization
+    can handle: BN folded into the convs, the residual and fuse sums
+    done by FloatFunctional, wrapped in quant / dequant stubs
+    '''
+    if not isinstance(model, PoseHighResolutionNet):
+        raise ValueError('{} can not be quantized, only pose_hrnet'.format(
+            model.__class__.__name__))
+
+    model = fuse_for_inference(model)
+    for m in model.modules():
+        for float_class, quant_class in _QUANTIZABLE:
+            if type(m) is float_class:
+                m.__class__ = quant_class
+                m._init_quantizable()
+                break
+
+    return QuantizablePoseNet(model).eval()
+
+
+def calibrate(model, loader, num_samples):
+    '''run the first num_samples inputs of loader through model'''
+    seen = 0
+    with torch.no_grad():
+        for input, _, _, _ in loader:
+            model(input[:num_samples - seen])
+            seen += min(input.size(0), num_samples - seen)
+            if seen >= num_samples:
+                break
+    logger.info('=> calibrated on {} samples'.format(seen))
+
+
+def quantize_model(model, calib_loader, num_samples, backend='fbgemm'):
+    '''
+    post-training static int8 quantization of a fp32 PoseHighResolutionNet
+    :param calib_loader: JointsDataset loader, only the inputs are used
+    :param backend: fbgemm (x86) or qnnpack (arm)
+    :return: quantized model, cpu only
+    '''
+    torch.backends.quantized.engine = backend
+    model = prepare_quantizable(model.cpu())
+    model.qconfig = quantization.get_default_qconfig(backend)
+    quantization.prepare(model, inplace=True)
+    calibrate(model, calib_loader, num_samples)
+    quantization.convert(model, inplace=True)
+    return model
@@ -8,8 +8,12 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import copy
+import hashlib
 import os
 import logging
+import pickle
+import re
 import time
 from collections import namedtuple
 from pathlib import Path
@@ -19,20 +23,49 @@ import torch.optim as optim
 import torch.nn as nn
 
 
-def create_logger(cfg, cfg_name, phase='train'):
-    root_output_dir = Path(cfg.OUTPUT_DIR)
-    # set up logger
-    if not root_output_dir.exists():
-        print('=> creating {}'.format(root_output_dir))
-        root_output_dir.mkdir()
-
+def _output_names(cfg, cfg_name):
     dataset = cfg.DATASET.DATASET + '_' + cfg.DATASET.HYBRID_JOINTS_TYPE \
         if cfg.DATASET.HYBRID_JOINTS_TYPE else cfg.DATASET.DATASET
     dataset = dataset.replace(':', '_')
     model = cfg.MODEL.NAME
     cfg_name = os.path.basename(cfg_name).split('.')[0]
+    return dataset, model, cfg_name
+
+
+def get_resume_time_str(cfg, cfg_name, filename='checkpoint.pth'):
+    '''
+    :return: the time_str of the latest output directory of this experiment
+             with a checkpoint, None if there is none
+    '''
+    dataset, model, cfg_name = _output_names(cfg, cfg_name)
+    checkpoints = [
+        path / filename for path in Path(cfg.OUTPUT_DIR).glob(
+            os.path.join(dataset, model, cfg_name + '_*'))
+        # not the directories of experiments named cfg_name + '_...'
+        if re.fullmatch(r'\d{2}(-\d{2}){4}', path.name[len(cfg_name) + 1:])
+        and (path / filename).exists()
+    ]
+    if not checkpoints:
+        return None
+    latest = max(checkpoints, key=lambda path: path.stat().st_mtime)
+    return latest.parent.name[len(cfg_name) + 1:]
+
+
+def create_logger(cfg, cfg_name, phase='train', time_str=None):
+    '''
+    :param time_str: names the output directories, every rank of a
+                     distributed run has to pass the same one
+    '''
+    root_output_dir = Path(cfg.OUTPUT_DIR)
+    # set up logger
+    if not root_output_dir.exists():
+        print('=> creating {}'.format(root_output_dir))
+        root_output_dir.mkdir(parents=True, exist_ok=True)
 
-    time_str = time.strftime('%y-%m-%d-%H-%M')
+    dataset, model, cfg_name = _output_names(cfg, cfg_name)
+
+    if time_str is None:
+        time_str = time.strftime('%y-%m-%d-%H-%M')
 
     final_output_dir = root_output_dir / dataset / model / (cfg_name + '_' + time_str)
 
@@ -40,14 +73,18 @@ def create_logger(cfg, cfg_name, phase='train'):
     final_output_dir.mkdir(parents=True, exist_ok=True)
 
     log_file = '{}_{}_{}.log'.format(cfg_name, time_str, phase)
+    if cfg.RANK > 0:
+        log_file = log_file.replace('.log', '_rank{}.log'.format(cfg.RANK))
     final_log_file = final_output_dir / log_file
     head = '%(asctime)-15s %(message)s'
     logging.basicConfig(filename=str(final_log_file),
                         format=head)
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
-    console = logging.StreamHandler()
-    logging.getLogger('').addHandler(console)
+    # the other ranks only log to their file
+    if cfg.RANK == 0:
+        console = logging.StreamHandler()
+        logging.getLogger('').addHandler(console)
 
     tensorboard_log_dir = Path(cfg.LOG_DIR) / dataset / model / \
         (cfg_name + '_' + time_str)
@@ -58,12 +95,17 @@ def create_logger(cfg, cfg_name, phase='train'):
     return logger, str(final_output_dir), str(tensorboard_log_dir)
 
 
-def get_optimizer(cfg, model):
+def get_optimizer(cfg, model, lr=None):
+    '''
+    :param lr: instead of cfg.TRAIN.LR, e.g. scaled to the batch size
+    '''
+    if lr is None:
+        lr = cfg.TRAIN.LR
     optimizer = None
     if cfg.TRAIN.OPTIMIZER == 'sgd':
         optimizer = optim.SGD(
             model.parameters(),
-            lr=cfg.TRAIN.LR,
+            lr=lr,
             momentum=cfg.TRAIN.MOMENTUM,
             weight_decay=cfg.TRAIN.WD,
             nesterov=cfg.TRAIN.NESTEROV
@@ -71,18 +113,80 @@ def get_optimizer(cfg, model):
     elif cfg.TRAIN.OPTIMIZER == 'adam':
         optimizer = optim.Adam(
             model.parameters(),
-            lr=cfg.TRAIN.LR
+            lr=lr
         )
 
     return optimizer
 
 
+def get_model_device(model):
+    for param in model.parameters():
+        return param.device
+    for buffer in model.buffers():
+        return buffer.device
+    return torch.device('cpu')
+
+
+def atomic_save(obj, path):
+    '''
+    torch.save to a temporary file next to path that replaces it once it
+    is on disk, so a preempted run never leaves path half written
+    '''
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            torch.save(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    # the rename itself is only durable once the directory is synced
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(os.path.dirname(os.path.abspath(path)),
+                     os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def load_cached(cache_dir, name, key, build):
+    '''
+    build() pickled to cache_dir and reused by every run with the same key,
+    built as usual without a cache_dir
+    :param key: everything the result depends on, compared by its repr
+    '''
+    if not cache_dir:
+        return build()
+
+    digest = hashlib.md5(repr(key).encode()).hexdigest()[:16]
+    cache_file = os.path.join(cache_dir, '{}_{}.pkl'.format(name, digest))
+    if os.path.exists(cache_file):
+        logging.getLogger(__name__).info(
+            '=> loading {} from {}'.format(name, cache_file))
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+
+    obj = build()
+    # concurrent runs may build the same file, each replaces it whole
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = '{}.tmp{}'.format(cache_file, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
+    return obj
+
+
 def save_checkpoint(states, is_best, output_dir,
                     filename='checkpoint.pth'):
-    torch.save(states, os.path.join(output_dir, filename))
+    atomic_save(states, os.path.join(output_dir, filename))
     if is_best and 'state_dict' in states:
-        torch.save(states['best_state_dict'],
-                   os.path.join(output_dir, 'model_best.pth'))
+        atomic_save(states['best_state_dict'],
+                    os.path.join(output_dir, 'model_best.pth'))
 
 
 def get_model_summary(model, *input_tensors, item_length=26, verbose=False):
@@ -201,4 +305,70 @@ def get_model_summary(model, *input_tensors, item_length=26, verbose=False):
     for layer in layer_instances:
         details += "{} : {} layers   ".format(layer, layer_instances[layer])
 
+    mode = getattr(model, 'checkpoint_mode', '')
+    if mode:
+        details += os.linesep + '-' * space_len * 5 + os.linesep \
+            + get_checkpoint_overhead(model, *input_tensors)
+
     return details
+
+
+def _profile_train_step(model, input_tensors, repeat):
+    '''
+    bytes of activations saved for backward (parameters excluded) and
+    seconds per forward + backward
+    '''
+    param_ptrs = set(p.data_ptr() for p in model.parameters())
+    saved = {}
+
+    def pack(tensor):
+        ptr = tensor.data_ptr()
+        if ptr not in param_ptrs:
+            saved[ptr] = max(saved.get(ptr, 0),
+                             tensor.numel() * tensor.element_size())
+        return tensor
+
+    def step():
+        output = model(*input_tensors)
+        if isinstance(output, list):
+            output = output[-1]
+        output.float().sum().backward()
+
+    device = get_model_device(model)
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        step()
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    model.zero_grad()
+
+    return sum(saved.values()), (time.perf_counter() - start) / repeat
+
+
+def get_checkpoint_overhead(model, *input_tensors, repeat=3):
+    """
+    compare a training step of model with its activation checkpointing
+    (model.set_checkpoint) against the same model without it
+    :return: summary line with the saved activation memory and time
+    """
+    mode = model.checkpoint_mode
+    model = copy.deepcopy(model)
+    model.train()
+
+    model.set_checkpoint('')
+    base_bytes, base_time = _profile_train_step(model, input_tensors, repeat)
+    model.set_checkpoint(mode)
+    ckpt_bytes, ckpt_time = _profile_train_step(model, input_tensors, repeat)
+
+    return "Activation Checkpointing ({}, batch {}): " \
+        "stored activations {:.1f} MB -> {:.1f} MB ({:+.0%}), " \
+        "train step {:.3f}s -> {:.3f}s ({:+.0%})".format(
+            mode, input_tensors[0].size(0),
+            base_bytes / 1024 ** 2, ckpt_bytes / 1024 ** 2,
+            ckpt_bytes / max(base_bytes, 1) - 1,
+            base_time, ckpt_time, ckpt_time / base_time - 1)
@@ -8,15 +8,23 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import atexit
+import logging
 import math
+import queue
+import threading
 
 import numpy as np
+import torch.nn.functional as F
 import torchvision
 import cv2
 
 from core.inference import get_max_preds
 
 
+logger = logging.getLogger(__name__)
+
+
 def save_batch_image_with_joints(batch_image, batch_joints, batch_joints_vis,
                                  file_name, nrow=8, padding=2):
     '''
@@ -51,6 +59,37 @@ def save_batch_image_with_joints(batch_image, batch_joints, batch_joints_vis,
     cv2.imwrite(file_name, ndarr)
 
 
+# (dx, dy) of the pixels cv2.circle sets for radius 1 and thickness 1,
+# the 4 edge neighbours
+_CIRCLE_OFFSETS = np.array([(0, -1), (-1, 0), (1, 0), (0, 1)])
+_jet_lut = None
+
+
+def _get_jet_lut():
+    global _jet_lut
+    if _jet_lut is None:
+        _jet_lut = cv2.applyColorMap(
+            np.arange(256, dtype=np.uint8).reshape(256, 1),
+            cv2.COLORMAP_JET
+        ).reshape(256, 3)
+    return _jet_lut
+
+
+def _draw_points(images, points, color):
+    '''
+    draw small circles with batched index writes
+    images: [num_images, height, width, 3], modified in place
+    points: [num_images, num_points, 2]
+    '''
+    num_images, height, width = images.shape[:3]
+    points = points.astype(np.int64)
+    xs = points[:, :, 0:1] + _CIRCLE_OFFSETS[:, 0]
+    ys = points[:, :, 1:2] + _CIRCLE_OFFSETS[:, 1]
+    ns = np.broadcast_to(np.arange(num_images)[:, None, None], xs.shape)
+    valid = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    images[ns[valid], ys[valid], xs[valid]] = color
+
+
 def save_batch_heatmaps(batch_image, batch_heatmaps, file_name,
                         normalize=True):
     '''
@@ -70,57 +109,163 @@ def save_batch_heatmaps(batch_image, batch_heatmaps, file_name,
     heatmap_height = batch_heatmaps.size(2)
     heatmap_width = batch_heatmaps.size(3)
 
-    grid_image = np.zeros((batch_size*heatmap_height,
-                           (num_joints+1)*heatmap_width,
-                           3),
-                          dtype=np.uint8)
-
     preds, maxvals = get_max_preds(batch_heatmaps.detach().cpu().numpy())
 
-    for i in range(batch_size):
-        image = batch_image[i].mul(255)\
-                              .clamp(0, 255)\
-                              .byte()\
-                              .permute(1, 2, 0)\
-                              .cpu().numpy()
-        heatmaps = batch_heatmaps[i].mul(255)\
-                                    .clamp(0, 255)\
-                                    .byte()\
-                                    .cpu().numpy()
-
-        resized_image = cv2.resize(image,
-                                   (int(heatmap_width), int(heatmap_height)))
-
-        height_begin = heatmap_height * i
-        height_end = heatmap_height * (i + 1)
-        for j in range(num_joints):
-            cv2.circle(resized_image,
-                       (int(preds[i][j][0]), int(preds[i][j][1])),
-                       1, [0, 0, 255], 1)
-            heatmap = heatmaps[j, :, :]
-            colored_heatmap = cv2.applyColorMap(heatmap, cv2.COLORMAP_JET)
-            masked_image = colored_heatmap*0.7 + resized_image*0.3
-            cv2.circle(masked_image,
-                       (int(preds[i][j][0]), int(preds[i][j][1])),
-                       1, [0, 0, 255], 1)
-
-            width_begin = heatmap_width * (j+1)
-            width_end = heatmap_width * (j+2)
-            grid_image[height_begin:height_end, width_begin:width_end, :] = \
-                masked_image
-            # grid_image[height_begin:height_end, width_begin:width_end, :] = \
-            #     colored_heatmap*0.7 + resized_image*0.3
-
-        grid_image[height_begin:height_end, 0:heatmap_width, :] = resized_image
+    # [batch_size, height, width, 3]
+    resized_images = F.interpolate(
+        batch_image.float(), size=(heatmap_height, heatmap_width),
+        mode='bilinear', align_corners=False
+    )
+    resized_images = resized_images.mul(255)\
+                                   .clamp(0, 255)\
+                                   .byte()\
+                                   .permute(0, 2, 3, 1)\
+                                   .cpu().numpy()
+    # [batch_size, num_joints, height, width]
+    heatmaps = batch_heatmaps.detach()\
+                             .mul(255)\
+                             .clamp(0, 255)\
+                             .byte()\
+                             .cpu().numpy()
+
+    # colormap with one lut gather and blend 0.7/0.3 in integers
+    colored_heatmaps = _get_jet_lut()[heatmaps]
+    masked_images = (
+        colored_heatmaps.astype(np.uint16) * 7 +
+        resized_images[:, None].astype(np.uint16) * 3
+    ) // 10
+    masked_images = masked_images.astype(np.uint8)
+
+    _draw_points(
+        masked_images.reshape((-1, heatmap_height, heatmap_width, 3)),
+        preds.reshape((-1, 1, 2)), [0, 0, 255]
+    )
+    _draw_points(resized_images, preds, [0, 0, 255])
+
+    grid_image = np.empty((batch_size, heatmap_height,
+                           num_joints + 1, heatmap_width, 3),
+                          dtype=np.uint8)
+    grid_image[:, :, 0] = resized_images
+    grid_image[:, :, 1:] = masked_images.transpose(0, 2, 1, 3, 4)
+    grid_image = grid_image.reshape((batch_size * heatmap_height,
+                                     (num_joints + 1) * heatmap_width,
+                                     3))
 
     cv2.imwrite(file_name, grid_image)
 
 
+class DebugImageWriter(object):
+    """
+    Renders and writes debug images on a worker thread. Jobs go through a
+    bounded queue and are dropped when it is full, so the training loop
+    never waits for the grids, colormaps and jpeg encoding.
+    """
+    def __init__(self, max_queue_size=4):
+        self.queue = queue.Queue(max_queue_size)
+        self.num_dropped = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def put(self, job):
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            self.num_dropped += 1
+            if self.num_dropped % 100 == 1:
+                logger.info('=> debug image writer busy, dropped {} '
+                            'frames so far'.format(self.num_dropped))
+            return False
+        return True
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            try:
+                _write_debug_images(*job)
+            except Exception:
+                logger.exception('=> fail to write debug images')
+
+
+_debug_image_writer = None
+
+
+def _get_debug_image_writer(config):
+    global _debug_image_writer
+    if _debug_image_writer is None:
+        _debug_image_writer = DebugImageWriter(
+            config.DEBUG.WRITER_QUEUE_SIZE
+        )
+    return _debug_image_writer
+
+
+def _to_uint8(batch, normalize=False):
+    batch = batch.detach()
+    if normalize:
+        min = float(batch.min())
+        max = float(batch.max())
+        batch = (batch - min) / (max - min + 1e-5)
+    return batch.mul(255).clamp(0, 255).byte().cpu()
+
+
+def _to_numpy(joints):
+    if hasattr(joints, 'cpu'):
+        joints = joints.cpu().numpy()
+    return np.array(joints, copy=True)
+
+
+def _write_debug_images(image, images_with_joints, heatmaps):
+    image = image.float().div_(255)
+    for joints, joints_vis, file_name in images_with_joints:
+        save_batch_image_with_joints(image, joints, joints_vis, file_name)
+    for batch_heatmaps, file_name in heatmaps:
+        save_batch_heatmaps(image, batch_heatmaps.float().div_(255),
+                            file_name, normalize=False)
+
+
 def save_debug_images(config, input, meta, target, joints_pred, output,
                       prefix):
     if not config.DEBUG.DEBUG:
         return
 
+    if config.DEBUG.ASYNC_WRITER:
+        # only detached uint8 copies are made here, the rendering happens
+        # on the writer thread
+        images_with_joints = []
+        heatmaps = []
+        if config.DEBUG.SAVE_BATCH_IMAGES_GT:
+            images_with_joints.append((
+                _to_numpy(meta['joints']), _to_numpy(meta['joints_vis']),
+                '{}_gt.jpg'.format(prefix)
+            ))
+        if config.DEBUG.SAVE_BATCH_IMAGES_PRED:
+            images_with_joints.append((
+                _to_numpy(joints_pred), _to_numpy(meta['joints_vis']),
+                '{}_pred.jpg'.format(prefix)
+            ))
+        if config.DEBUG.SAVE_HEATMAPS_GT:
+            heatmaps.append((
+                _to_uint8(target), '{}_hm_gt.jpg'.format(prefix)
+            ))
+        if config.DEBUG.SAVE_HEATMAPS_PRED:
+            heatmaps.append((
+                _to_uint8(output), '{}_hm_pred.jpg'.format(prefix)
+            ))
+
+        if images_with_joints or heatmaps:
+            _get_debug_image_writer(config).put((
+                _to_uint8(input, normalize=True), images_with_joints,
+                heatmaps
+            ))
+        return
+
     if config.DEBUG.SAVE_BATCH_IMAGES_GT:
         save_batch_image_with_joints(
             input, meta['joints'], meta['joints_vis'],
@@ -1,18 +1,9 @@
 #!/bin/bash
-x=1
-while [ $x -le 4 ]
-do
-  echo "Training for -12 OCC_MIN_JOINT, 1 OCC_HIDE_NUM: $x th times"
-  python tools/train.py --cfg experiments/coco/hrnet/w32_256x192_adam_lr1e-3_occ_12_1.yaml
-  x=$(( $x + 1 ))
-done
-
-x=1
-while [ $x -le 4 ]
-do
-  echo "Training for -10 OCC_MIN_JOINT, 2 OCC_HIDE_NUM: $x th times"
-  python tools/train.py --cfg experiments/coco/hrnet/w32_256x192_adam_lr1e-3_occ_10_2.yaml
-  x=$(( $x + 1 ))
-done
-
-echo "Expreiment Finished!"
+# 4 seeds of -12 OCC_MIN_JOINT, 1 OCC_HIDE_NUM and of -10 OCC_MIN_JOINT,
+# 2 OCC_HIDE_NUM, scheduled over the visible gpus. Run it again to resume.
+python tools/sweep.py \
+    --cfg experiments/coco/hrnet/w32_256x192_adam_lr1e-3_occ_10_2.yaml \
+    --name occ_exp \
+    --grid DATASET.OCC_MIN_JOINT=12 DATASET.OCC_HIDE_NUM=1 \
+    --grid DATASET.OCC_MIN_JOINT=10 DATASET.OCC_HIDE_NUM=2 \
+    --seeds 0 1 2 3
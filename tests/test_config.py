@@ -0,0 +1,41 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, os.path.join(ROOT, 'lib'))
+
+from config import cfg
+from config import update_config
+
+
+def get_config(opts):
+    args = argparse.Namespace(
+        cfg=os.path.join(
+            ROOT, 'experiments/coco/hrnet/w32_256x192_adam_lr1e-3.yaml'),
+        opts=opts, modelDir='', logDir='', dataDir='')
+    config = cfg.clone()
+    update_config(config, args)
+    return config
+
+
+def test_model_extra_defaults():
+    config = get_config([])
+    assert config.MODEL.EXTRA.CHECKPOINT == ''
+    assert config.MODEL.EXTRA.INPLACE_FUSE is False
+
+
+def test_model_extra_from_list():
+    config = get_config(['MODEL.EXTRA.CHECKPOINT', 'branch',
+                         'MODEL.EXTRA.INPLACE_FUSE', 'True'])
+    assert config.MODEL.EXTRA.CHECKPOINT == 'branch'
+    assert config.MODEL.EXTRA.INPLACE_FUSE is True
@@ -0,0 +1,194 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import copy
+import pprint
+
+import torch
+import torch.backends.cudnn as cudnn
+import torch.utils.data
+import torchvision.transforms as transforms
+
+import _init_paths
+from config import cfg
+from config import update_config
+from core.loss import get_loss
+from core.function import validate
+from utils.amp import measure_latency
+from utils.amp import prepare_inference_model
+from utils.utils import create_logger
+
+import dataset
+import models
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Compare inference modes against the fp32 baseline')
+    parser.add_argument('--cfg',
+                        help='experiment configure file name',
+                        required=True,
+                        type=str)
+    parser.add_argument('opts',
+                        help="Modify config options using the command-line",
+                        default=None,
+                        nargs=argparse.REMAINDER)
+    parser.add_argument('--batchSize',
+                        help='batch size of the latency inputs',
+                        type=int,
+                        default=1)
+    parser.add_argument('--iters',
+                        help='timed forward passes per mode',
+                        type=int,
+                        default=50)
+    parser.add_argument('--warmup',
+                        help='untimed forward passes per mode',
+                        type=int,
+                        default=10)
+    parser.add_argument('--ap',
+                        help='also evaluate every mode on DATASET.TEST_SET',
+                        action='store_true')
+
+    # update_config reads these
+    parser.add_argument('--modelDir', type=str, default='')
+    parser.add_argument('--logDir', type=str, default='')
+    parser.add_argument('--dataDir', type=str, default='')
+    parser.add_argument('--prevModelDir', type=str, default='')
+
+    args = parser.parse_args()
+    return args
+
+
+def with_inference_mode(config, precision, channels_last, fuse_bn):
+    config = config.clone()
+    config.defrost()
+    config.TEST.PRECISION = precision
+    config.TEST.CHANNELS_LAST = channels_last
+    config.TEST.FUSE_BN = fuse_bn
+    config.freeze()
+    return config
+
+
+def load_model(config, logger):
+    model = eval('models.'+config.MODEL.NAME+'.get_pose_net')(
+        config, is_train=False
+    )
+    if config.TEST.MODEL_FILE:
+        logger.info('=> loading model from {}'.format(config.TEST.MODEL_FILE))
+        model.load_state_dict(
+            torch.load(config.TEST.MODEL_FILE, map_location='cpu'),
+            strict=False
+        )
+    else:
+        logger.info('=> TEST.MODEL_FILE is not set, timing random weights')
+    model.eval()
+    return model
+
+
+def evaluate_ap(config, model, output_dir, tb_log_dir):
+    normalize = transforms.Normalize(
+        mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
+    )
+    valid_dataset = eval('dataset.'+config.DATASET.DATASET)(
+        config, config.DATASET.ROOT, config.DATASET.TEST_SET, False,
+        transforms.Compose([
+            transforms.ToTensor(),
+            normalize,
+        ])
+    )
+    valid_loader = torch.utils.data.DataLoader(
+        valid_dataset,
+        batch_size=config.TEST.BATCH_SIZE_PER_GPU,
+        shuffle=False,
+        num_workers=config.WORKERS,
+        pin_memory=True
+    )
+    criterion = get_loss(config)
+    return validate(config, valid_loader, valid_dataset, model, criterion,
+                    output_dir, tb_log_dir)
+
+
+def get_modes(config):
+    '''
+    [(name, config)], the fp32 baseline first
+    '''
+    modes = [('fp32', with_inference_mode(config, 'fp32', False, False))]
+    if config.TEST.FUSE_BN:
+        modes.append(('fp32 fused',
+                      with_inference_mode(config, 'fp32', False, True)))
+    if config.TEST.CHANNELS_LAST:
+        modes.append(('fp32 channels_last',
+                      with_inference_mode(config, 'fp32', True, False)))
+    if config.TEST.PRECISION != 'fp32' or len(modes) > 2:
+        name = config.TEST.PRECISION
+        if config.TEST.FUSE_BN:
+            name += ' fused'
+        if config.TEST.CHANNELS_LAST:
+            name += ' channels_last'
+        modes.append((name, config))
+    return modes
+
+
+def main():
+    args = parse_args()
+    update_config(cfg, args)
+
+    logger, final_output_dir, tb_log_dir = create_logger(
+        cfg, args.cfg, 'benchmark')
+
+    logger.info(pprint.pformat(args))
+    logger.info(cfg)
+
+    cudnn.benchmark = cfg.CUDNN.BENCHMARK
+    torch.backends.cudnn.deterministic = cfg.CUDNN.DETERMINISTIC
+    torch.backends.cudnn.enabled = cfg.CUDNN.ENABLED
+
+    device = torch.device('cuda', cfg.GPUS[0]) \
+        if torch.cuda.is_available() else torch.device('cpu')
+    model = load_model(cfg, logger)
+
+    # the same inputs for every mode
+    generator = torch.Generator().manual_seed(0)
+    inputs = torch.randn(
+        (args.batchSize, 3, cfg.MODEL.IMAGE_SIZE[1], cfg.MODEL.IMAGE_SIZE[0]),
+        generator=generator
+    )
+
+    results = []
+    reference = None
+    for name, config in get_modes(cfg):
+        logger.info('=> benchmarking {} on {}'.format(name, device))
+        mode_model = prepare_inference_model(
+            config, copy.deepcopy(model), device)
+        latency, output = measure_latency(
+            config, mode_model, inputs, device, args.warmup, args.iters)
+        if reference is None:
+            reference = output
+        max_diff = (output - reference).abs().max().item()
+
+        ap = None
+        if args.ap:
+            ap = evaluate_ap(config, mode_model, final_output_dir, tb_log_dir)
+        results.append((name, latency, max_diff, ap))
+        del mode_model
+
+    baseline = results[0][1]
+    logger.info('| Mode | ms/batch | img/s | Speedup | Max diff | AP |')
+    logger.info('|---|---|---|---|---|---|')
+    for name, latency, max_diff, ap in results:
+        logger.info('| {} | {:.2f} | {:.1f} | {:.2f}x | {:.4f} | {} |'.format(
+            name, latency, args.batchSize * 1000 / latency,
+            baseline / latency, max_diff,
+            '{:.3f}'.format(ap) if ap is not None else '-'
+        ))
+
+
+if __name__ == '__main__':
+    main()
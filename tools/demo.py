@@ -39,6 +39,12 @@ import models
 from config import cfg
 from config import update_config
 from core.inference import get_final_preds
+from utils.amp import autocast
+from utils.amp import get_autocast_dtype
+from utils.amp import get_memory_format
+from utils.amp import prepare_inference_model
+from utils.compile import compile_model
+from utils.export import load_exported_model
 from utils.transforms import get_affine_transform
 import matplotlib.lines as mlines
 import matplotlib.patches as mpatches
@@ -201,7 +207,11 @@ def get_pose_estimation_prediction(pose_model, image, centers, scales, transform
         # print(model_input.shape)
 
         # compute output heatmap
-        output = pose_model(model_inputs.to(CTX))
+        model_inputs = model_inputs.to(CTX).contiguous(
+            memory_format=get_memory_format(cfg))
+        with autocast(CTX, get_autocast_dtype(cfg.TEST.PRECISION, CTX)):
+            output = pose_model(model_inputs)
+        output = output.float()
         coords, _ = get_final_preds(
             cfg,
             output.cpu().detach().numpy(),
@@ -694,19 +704,26 @@ def main():
         # box_model = torchvision.models.detection.fasterrcnn_mobilenet_v3_large_fpn(pretrained=True)
         box_model.to(CTX)
         box_model.eval()
-    pose_model = eval('models.' + cfg.MODEL.NAME + '.get_pose_net')(
-        cfg, is_train=False
-    )
     # SHOW_IMAGES = args.showImages
 
-    if cfg.TEST.MODEL_FILE:
-        print('=> loading model from {}'.format(cfg.TEST.MODEL_FILE))
-        pose_model.load_state_dict(torch.load(cfg.TEST.MODEL_FILE), strict=False)
+    if cfg.TEST.EXPORTED_MODEL:
+        print('=> loading exported model from {}'.format(cfg.TEST.EXPORTED_MODEL))
+        pose_model = load_exported_model(cfg.TEST.EXPORTED_MODEL, CTX)
     else:
-        print('expected model defined in config at TEST.MODEL_FILE')
+        pose_model = eval('models.' + cfg.MODEL.NAME + '.get_pose_net')(
+            cfg, is_train=False
+        )
 
-    pose_model.to(CTX)
-    pose_model.eval()
+        if cfg.TEST.MODEL_FILE:
+            print('=> loading model from {}'.format(cfg.TEST.MODEL_FILE))
+            pose_model.load_state_dict(torch.load(cfg.TEST.MODEL_FILE), strict=False)
+        else:
+            print('expected model defined in config at TEST.MODEL_FILE')
+
+        pose_model.eval()
+        pose_model = prepare_inference_model(cfg, pose_model, CTX)
+        pose_model = compile_model(cfg, pose_model, torch.randn(
+            1, 3, cfg.MODEL.IMAGE_SIZE[1], cfg.MODEL.IMAGE_SIZE[0]))
 
     if use_json:
         """
@@ -0,0 +1,172 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import inspect
+import os
+import pprint
+
+import torch
+
+import _init_paths
+from config import cfg
+from config import update_config
+from utils.export import load_exported_model
+from utils.fusion import fuse_for_inference
+from utils.utils import create_logger
+
+import models
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Export a pose model to TorchScript / ONNX')
+    parser.add_argument('--cfg',
+                        help='experiment configure file name',
+                        required=True,
+                        type=str)
+    parser.add_argument('opts',
+                        help="Modify config options using the command-line",
+                        default=None,
+                        nargs=argparse.REMAINDER)
+    parser.add_argument('--format',
+                        help='torchscript, onnx or all',
+                        type=str,
+                        default='all')
+    parser.add_argument('--fuse',
+                        help='fold BatchNorm into the convs before exporting',
+                        action='store_true')
+    parser.add_argument('--output',
+                        help='output directory, the experiment output '
+                             'directory by default',
+                        type=str,
+                        default='')
+    parser.add_argument('--batchSize',
+                        help='batch size of the example and check inputs',
+                        type=int,
+                        default=1)
+    parser.add_argument('--opset',
+                        help='ONNX opset version',
+                        type=int,
+                        default=11)
+    parser.add_argument('--rtol', type=float, default=1e-3)
+    parser.add_argument('--atol', type=float, default=1e-4)
+
+    # update_config reads these
+    parser.add_argument('--modelDir', type=str, default='')
+    parser.add_argument('--logDir', type=str, default='')
+    parser.add_argument('--dataDir', type=str, default='')
+    parser.add_argument('--prevModelDir', type=str, default='')
+
+    args = parser.parse_args()
+    return args
+
+
+def export_torchscript(model, example, path):
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+    traced.save(path)
+
+
+def export_onnx(model, example, path, opset):
+    # IMAGE_SIZE is fixed, only the batch dimension stays dynamic
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # the tracing exporter, newer torch defaults to the dynamo one
+        kwargs['dynamo'] = False
+    with torch.no_grad():
+        torch.onnx.export(
+            model, example, path,
+            input_names=['input'],
+            output_names=['heatmaps'],
+            dynamic_axes={'input': {0: 'batch'}, 'heatmaps': {0: 'batch'}},
+            opset_version=opset,
+            **kwargs
+        )
+
+
+def check_exported(model, path, example, rtol, atol, logger):
+    '''
+    compare the exported model with eager mode on example and on a batch
+    of a different size
+    '''
+    exported = load_exported_model(path, torch.device('cpu'))
+    inputs = [example, torch.cat([example, example.flip(3)])]
+    with torch.no_grad():
+        for input in inputs:
+            expected = model(input)
+            output = exported(input)
+            max_diff = (output - expected).abs().max().item()
+            logger.info('=> {} batch {}: max abs diff {:.3e}'.format(
+                os.path.basename(path), input.size(0), max_diff))
+            if not torch.allclose(output, expected, rtol=rtol, atol=atol):
+                raise ValueError(
+                    '{} does not match the eager model'.format(path))
+
+
+def main():
+    args = parse_args()
+    update_config(cfg, args)
+
+    logger, final_output_dir, _ = create_logger(cfg, args.cfg, 'export')
+
+    logger.info(pprint.pformat(args))
+    logger.info(cfg)
+
+    formats = ['torchscript', 'onnx'] if args.format == 'all' \
+        else [args.format]
+
+    model = eval('models.'+cfg.MODEL.NAME+'.get_pose_net')(
+        cfg, is_train=False
+    )
+    if cfg.TEST.MODEL_FILE:
+        logger.info('=> loading model from {}'.format(cfg.TEST.MODEL_FILE))
+        model.load_state_dict(
+            torch.load(cfg.TEST.MODEL_FILE, map_location='cpu'),
+            strict=False
+        )
+    else:
+        logger.info('=> TEST.MODEL_FILE is not set, exporting random weights')
+    model.eval()
+    if args.fuse:
+        model = fuse_for_inference(model)
+
+    output_dir = args.output or final_output_dir
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    # HxW like the experiment names, IMAGE_SIZE is [W, H]
+    name = '{}_{}x{}{}'.format(
+        cfg.MODEL.NAME, cfg.MODEL.IMAGE_SIZE[1], cfg.MODEL.IMAGE_SIZE[0],
+        '_fused' if args.fuse else '')
+
+    generator = torch.Generator().manual_seed(0)
+    example = torch.randn(
+        (args.batchSize, 3, cfg.MODEL.IMAGE_SIZE[1], cfg.MODEL.IMAGE_SIZE[0]),
+        generator=generator
+    )
+
+    for fmt in formats:
+        if fmt == 'torchscript':
+            path = os.path.join(output_dir, name + '.pt')
+            export_torchscript(model, example, path)
+        elif fmt == 'onnx':
+            path = os.path.join(output_dir, name + '.onnx')
+            export_onnx(model, example, path, args.opset)
+        else:
+            raise ValueError('Unknown export format: {}'.format(fmt))
+        logger.info('=> exported {}'.format(path))
+
+        try:
+            check_exported(model, path, example, args.rtol, args.atol, logger)
+        except ImportError as e:
+            logger.warning('=> can not check {}: {}'.format(path, e))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import pprint
+
+import torch
+import yaml
+
+import _init_paths
+from config import cfg
+from config import update_config
+from utils.amp import measure_latency
+from utils.pruning import prune_state_dict
+from utils.utils import create_logger
+from utils.utils import get_model_summary
+
+import models
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Prune HRNet branch widths by BN gamma')
+    parser.add_argument('--cfg',
+                        help='experiment configure file name',
+                        required=True,
+                        type=str)
+    parser.add_argument('opts',
+                        help="Modify config options using the command-line",
+                        default=None,
+                        nargs=argparse.REMAINDER)
+    parser.add_argument('--width',
+                        help='channels of the highest resolution branch, '
+                             'the others are scaled along',
+                        required=True,
+                        type=int)
+    parser.add_argument('--epochs',
+                        help='fine-tuning epochs written to the config, '
+                             'LR_STEP is scaled along',
+                        type=int,
+                        default=0)
+    parser.add_argument('--output',
+                        help='output directory, the experiment output '
+                             'directory by default',
+                        type=str,
+                        default='')
+
+    # update_config reads these
+    parser.add_argument('--modelDir', type=str, default='')
+    parser.add_argument('--logDir', type=str, default='')
+    parser.add_argument('--dataDir', type=str, default='')
+    parser.add_argument('--prevModelDir', type=str, default='')
+
+    args = parser.parse_args()
+    return args
+
+
+def write_pruned_config(args, widths, weights_file, path):
+    '''
+    the experiment file of args.cfg with the pruned NUM_CHANNELS, starting
+    from weights_file when trained with train.py or tested with test.py
+    '''
+    with open(args.cfg) as f:
+        exp_config = yaml.safe_load(f)
+
+    model_config = exp_config['MODEL']
+    for stage, num_channels in widths.items():
+        model_config['EXTRA'][stage]['NUM_CHANNELS'] = num_channels
+    model_config['INIT_WEIGHTS'] = True
+    model_config['PRETRAINED'] = weights_file
+    model_config['EXTRA']['PRETRAINED_LAYERS'] = ['*']
+    exp_config.setdefault('TEST', {})['MODEL_FILE'] = weights_file
+
+    if args.epochs:
+        train_config = exp_config.setdefault('TRAIN', {})
+        end_epoch = train_config.get('END_EPOCH', cfg.TRAIN.END_EPOCH)
+        lr_step = train_config.get('LR_STEP', list(cfg.TRAIN.LR_STEP))
+        train_config['BEGIN_EPOCH'] = 0
+        train_config['END_EPOCH'] = args.epochs
+        train_config['LR_STEP'] = [
+            int(step * args.epochs / end_epoch) for step in lr_step
+        ]
+
+    with open(path, 'w') as f:
+        yaml.safe_dump(exp_config, f, default_flow_style=False)
+
+
+def main():
+    args = parse_args()
+    update_config(cfg, args)
+
+    logger, final_output_dir, _ = create_logger(cfg, args.cfg, 'prune')
+
+    logger.info(pprint.pformat(args))
+    logger.info(cfg)
+
+    if not cfg.TEST.MODEL_FILE:
+        logger.error('=> set TEST.MODEL_FILE to the model to prune')
+        raise ValueError('TEST.MODEL_FILE is not set')
+
+    model = eval('models.'+cfg.MODEL.NAME+'.get_pose_net')(
+        cfg, is_train=False
+    )
+    logger.info('=> loading model from {}'.format(cfg.TEST.MODEL_FILE))
+    model.load_state_dict(
+        torch.load(cfg.TEST.MODEL_FILE, map_location='cpu'))
+    model.eval()
+
+    widths, state_dict = prune_state_dict(model, cfg, args.width)
+
+    output_dir = args.output or final_output_dir
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    name = '{}_w{}'.format(
+        os.path.basename(args.cfg).split('.')[0], args.width)
+    weights_file = os.path.abspath(os.path.join(output_dir, name + '.pth'))
+    torch.save(state_dict, weights_file)
+    logger.info('=> saved pruned weights to {}'.format(weights_file))
+
+    config_file = os.path.join(output_dir, name + '.yaml')
+    write_pruned_config(args, widths, weights_file, config_file)
+    logger.info('=> saved pruned config to {}'.format(config_file))
+
+    # the pruned model has to load strictly from the new config
+    pruned_cfg = cfg.clone()
+    pruned_cfg.defrost()
+    for stage, num_channels in widths.items():
+        pruned_cfg.MODEL.EXTRA[stage].NUM_CHANNELS = num_channels
+    pruned_cfg.freeze()
+    pruned = eval('models.'+cfg.MODEL.NAME+'.get_pose_net')(
+        pruned_cfg, is_train=False
+    )
+    pruned.load_state_dict(state_dict)
+    pruned.eval()
+
+    dump_input = torch.rand(
+        (1, 3, cfg.MODEL.IMAGE_SIZE[1], cfg.MODEL.IMAGE_SIZE[0])
+    )
+    logger.info(get_model_summary(pruned, dump_input))
+
+    device = torch.device('cuda', cfg.GPUS[0]) \
+        if torch.cuda.is_available() else torch.device('cpu')
+    latencies = []
+    for m in [model, pruned]:
+        latency, _ = measure_latency(
+            cfg, m.to(device), dump_input, device, warmup=3, iters=20)
+        latencies.append(latency)
+    logger.info('=> width {} -> {}: {:.2f}ms -> {:.2f}ms per image'.format(
+        cfg.MODEL.EXTRA.STAGE2.NUM_CHANNELS[0], args.width,
+        latencies[0], latencies[1]))
+    logger.info('=> fine-tune with: python tools/train.py --cfg {}'.format(
+        config_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import pprint
+
+import torch
+import torch.utils.data
+import torchvision.transforms as transforms
+
+import _init_paths
+from config import cfg
+from config import update_config
+from core.loss import get_loss
+from core.function import validate
+from utils.amp import measure_latency
+from utils.quantization import quantize_model
+from utils.utils import create_logger
+
+import dataset
+import models
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Post-training int8 quantization for cpu inference')
+    parser.add_argument('--cfg',
+                        help='experiment configure file name',
+                        required=True,
+                        type=str)
+    parser.add_argument('opts',
+                        help="Modify config options using the command-line",
+                        default=None,
+                        nargs=argparse.REMAINDER)
+    parser.add_argument('--backend',
+                        help='fbgemm (x86) or qnnpack (arm)',
+                        type=str,
+                        default='fbgemm')
+    parser.add_argument('--calibSamples',
+                        help='number of DATASET.TEST_SET crops to calibrate on',
+                        type=int,
+                        default=300)
+    parser.add_argument('--iters',
+                        help='timed forward passes per model',
+                        type=int,
+                        default=20)
+    parser.add_argument('--noEval',
+                        help='only report latency, skip validate',
+                        action='store_true')
+    parser.add_argument('--output',
+                        help='output directory, the experiment output '
+                             'directory by default',
+                        type=str,
+                        default='')
+
+    # update_config reads these
+    parser.add_argument('--modelDir', type=str, default='')
+    parser.add_argument('--logDir', type=str, default='')
+    parser.add_argument('--dataDir', type=str, default='')
+    parser.add_argument('--prevModelDir', type=str, default='')
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    update_config(cfg, args)
+
+    logger, final_output_dir, tb_log_dir = create_logger(
+        cfg, args.cfg, 'quantize')
+
+    logger.info(pprint.pformat(args))
+    logger.info(cfg)
+
+    model = eval('models.'+cfg.MODEL.NAME+'.get_pose_net')(
+        cfg, is_train=False
+    )
+    if cfg.TEST.MODEL_FILE:
+        logger.info('=> loading model from {}'.format(cfg.TEST.MODEL_FILE))
+        model.load_state_dict(
+            torch.load(cfg.TEST.MODEL_FILE, map_location='cpu'),
+            strict=False
+        )
+    else:
+        logger.info('=> TEST.MODEL_FILE is not set, quantizing random weights')
+    model.eval()
+
+    normalize = transforms.Normalize(
+        mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
+    )
+    valid_dataset = eval('dataset.'+cfg.DATASET.DATASET)(
+        cfg, cfg.DATASET.ROOT, cfg.DATASET.TEST_SET, False,
+        transforms.Compose([
+            transforms.ToTensor(),
+            normalize,
+        ])
+    )
+
+    # a fixed random subset of the person crops
+    generator = torch.Generator().manual_seed(0)
+    indices = torch.randperm(len(valid_dataset), generator=generator)
+    calib_loader = torch.utils.data.DataLoader(
+        torch.utils.data.Subset(
+            valid_dataset, indices[:args.calibSamples].tolist()),
+        batch_size=cfg.TEST.BATCH_SIZE_PER_GPU,
+        shuffle=False,
+        num_workers=cfg.WORKERS
+    )
+    quantized = quantize_model(
+        model, calib_loader, args.calibSamples, args.backend)
+
+    # scripted, so demo.py / test.py can load it as TEST.EXPORTED_MODEL
+    example = torch.randn(
+        (1, 3, cfg.MODEL.IMAGE_SIZE[1], cfg.MODEL.IMAGE_SIZE[0]),
+        generator=generator
+    )
+    output_dir = args.output or final_output_dir
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    # HxW like the experiment names, IMAGE_SIZE is [W, H]
+    path = os.path.join(output_dir, '{}_{}x{}_int8_{}.pt'.format(
+        cfg.MODEL.NAME, cfg.MODEL.IMAGE_SIZE[1], cfg.MODEL.IMAGE_SIZE[0],
+        args.backend))
+    with torch.no_grad():
+        torch.jit.trace(quantized, example).save(path)
+    logger.info('=> saved quantized model to {}'.format(path))
+
+    device = torch.device('cpu')
+    results = []
+    for name, m in [('fp32', model), ('int8', quantized)]:
+        latency, _ = measure_latency(
+            cfg, m, example, device, warmup=3, iters=args.iters)
+
+        ap = None
+        if not args.noEval:
+            valid_loader = torch.utils.data.DataLoader(
+                valid_dataset,
+                batch_size=cfg.TEST.BATCH_SIZE_PER_GPU,
+                shuffle=False,
+                num_workers=cfg.WORKERS
+            )
+            criterion = get_loss(cfg)
+            ap = validate(cfg, valid_loader, valid_dataset, m, criterion,
+                          final_output_dir, tb_log_dir)
+        results.append((name, latency, ap))
+
+    baseline = results[0][1]
+    logger.info('| Model | ms/image (cpu) | Speedup | AP |')
+    logger.info('|---|---|---|---|')
+    for name, latency, ap in results:
+        logger.info('| {} | {:.2f} | {:.2f}x | {} |'.format(
+            name, latency, baseline / latency,
+            '{:.3f}'.format(ap) if ap is not None else '-'
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,364 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import csv
+import itertools
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import numpy as np
+import torch
+import yaml
+
+import _init_paths
+from config import cfg
+from config import update_config
+
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Train a grid of experiments over the available devices')
+    parser.add_argument('--cfg',
+                        help='base experiment configure file name',
+                        required=True,
+                        type=str)
+    parser.add_argument('opts',
+                        help="Modify config options of every run using "
+                             "the command-line",
+                        default=None,
+                        nargs=argparse.REMAINDER)
+    parser.add_argument('--grid',
+                        help='KEY=V1,V2 ... overrides, every combination is '
+                             'a run, repeat --grid for several grids',
+                        action='append',
+                        nargs='+',
+                        default=[])
+    parser.add_argument('--seeds',
+                        help='SEED of the runs, each combination is trained '
+                             'once per seed',
+                        type=int,
+                        nargs='+',
+                        default=[0])
+    parser.add_argument('--name',
+                        help='sweep name, the base config name by default',
+                        type=str,
+                        default='')
+    parser.add_argument('--devices',
+                        help='gpu ids to use, e.g. 0,1,2,3, or cpu, all '
+                             'visible gpus by default',
+                        type=str,
+                        default='')
+    parser.add_argument('--gpusPerRun',
+                        help='gpus of every run',
+                        type=int,
+                        default=1)
+    parser.add_argument('--maxParallel',
+                        help='runs at the same time, one per device slot '
+                             'by default (one on the cpu)',
+                        type=int,
+                        default=0)
+    parser.add_argument('--ddp',
+                        help='launch runs with several gpus with torchrun '
+                             'instead of DataParallel',
+                        action='store_true')
+    parser.add_argument('--dryRun',
+                        help='only write the configs and list the runs',
+                        action='store_true')
+
+    # update_config reads these, they are passed on to every run
+    parser.add_argument('--modelDir', type=str, default='')
+    parser.add_argument('--logDir', type=str, default='')
+    parser.add_argument('--dataDir', type=str, default='')
+    parser.add_argument('--prevModelDir', type=str, default='')
+
+    args = parser.parse_args()
+    return args
+
+
+def parse_grid(grid):
+    '''
+    :param grid: KEY=V1,V2 strings, the values are parsed as yaml
+    :return: list of override dicts, one per combination
+    '''
+    keys = []
+    values = []
+    for item in grid:
+        key, _, value = item.partition('=')
+        if not value:
+            raise ValueError('expected KEY=V1,V2, got {}'.format(item))
+        keys.append(key)
+        values.append([yaml.safe_load(v) for v in value.split(',')])
+    return [dict(zip(keys, combination))
+            for combination in itertools.product(*values)]
+
+
+def get_key(config, key):
+    for name in key.split('.'):
+        config = config[name]
+    return config
+
+
+def run_name(base_name, overrides, seed):
+    parts = ['{}{}'.format(key.split('.')[-1].lower(), value)
+             for key, value in overrides.items()]
+    return '_'.join([base_name] + parts + ['seed{}'.format(seed)])
+
+
+def write_run_config(base_file, overrides, seed, path):
+    '''
+    the experiment file of base_file with the overrides and SEED
+    '''
+    with open(base_file) as f:
+        exp_config = yaml.safe_load(f)
+
+    for key, value in overrides.items():
+        node = exp_config
+        names = key.split('.')
+        for name in names[:-1]:
+            node = node.setdefault(name, {})
+        node[names[-1]] = value
+    exp_config['SEED'] = seed
+
+    with open(path, 'w') as f:
+        yaml.safe_dump(exp_config, f, default_flow_style=False)
+
+
+def get_slots(args):
+    '''
+    :return: CUDA_VISIBLE_DEVICES of every slot, '' for the cpu
+    '''
+    if args.devices == 'cpu' or \
+            (not args.devices and not torch.cuda.is_available()):
+        return [''] * max(args.maxParallel, 1)
+
+    if args.devices:
+        devices = args.devices.split(',')
+    else:
+        devices = [str(i) for i in range(torch.cuda.device_count())]
+    slots = [
+        ','.join(devices[i:i + args.gpusPerRun])
+        for i in range(0, len(devices) - args.gpusPerRun + 1, args.gpusPerRun)
+    ]
+    if args.maxParallel > 0:
+        slots = slots[:args.maxParallel]
+    return slots
+
+
+def get_command(args, run, slot, cache_dir):
+    train_file = os.path.join(os.path.dirname(__file__), 'train.py')
+    num_gpus = len(slot.split(',')) if slot else 1
+    command = [sys.executable, train_file]
+    if args.ddp and num_gpus > 1:
+        command = [sys.executable, '-m', 'torch.distributed.run',
+                   '--standalone', '--nproc_per_node', str(num_gpus),
+                   train_file]
+
+    command += ['--cfg', run['cfg']]
+    for arg in ['modelDir', 'logDir', 'dataDir', 'prevModelDir']:
+        if getattr(args, arg):
+            command += ['--' + arg, getattr(args, arg)]
+
+    # an interrupted run continues from its checkpoint
+    command += ['AUTO_RESUME', 'True', 'DATASET.CACHE_DIR', cache_dir]
+    if slot:
+        command += ['GPUS', '({},)'.format(
+            ','.join(str(i) for i in range(num_gpus)))]
+    return command + args.opts
+
+
+class SweepState(object):
+    """
+    status of every run in sweep_dir/sweep_state.json, a restarted sweep
+    launches the runs that are not done again
+    """
+    def __init__(self, path):
+        self.path = path
+        self.runs = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.runs = json.load(f)
+
+    def add(self, name, run):
+        if name not in self.runs:
+            self.runs[name] = dict(run, status='pending', attempts=0)
+        self.save()
+
+    def update(self, name, **kwargs):
+        self.runs[name].update(kwargs)
+        self.save()
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.runs, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def run_sweep(args, state, names, slots, log_dir, cache_dir):
+    pending = [name for name in names
+               if state.runs[name]['status'] != 'done']
+    logger.info('=> {} of {} runs to train on {} slots'.format(
+        len(pending), len(names), len(slots)))
+
+    # slot index -> name, process, log file
+    running = {}
+    try:
+        while pending or running:
+            for i, slot in enumerate(slots):
+                if i in running or not pending:
+                    continue
+                name = pending.pop(0)
+                run = state.runs[name]
+                command = get_command(args, run, slot, cache_dir)
+                env = dict(os.environ, CUDA_VISIBLE_DEVICES=slot)
+                log_file = open(os.path.join(log_dir, name + '.log'), 'a')
+                process = subprocess.Popen(
+                    command, stdout=log_file, stderr=subprocess.STDOUT,
+                    env=env, start_new_session=True)
+                running[i] = (name, process, log_file)
+                state.update(name, status='running',
+                             attempts=run['attempts'] + 1)
+                logger.info('=> started {} on {}'.format(
+                    name, 'gpu ' + slot if slot else 'cpu'))
+
+            time.sleep(5)
+            for i, (name, process, log_file) in list(running.items()):
+                returncode = process.poll()
+                if returncode is None:
+                    continue
+                log_file.close()
+                del running[i]
+                status = 'done' if returncode == 0 else 'failed'
+                state.update(name, status=status, returncode=returncode)
+                logger.info('=> {} {} ({} running, {} pending)'.format(
+                    name, status, len(running), len(pending)))
+    finally:
+        # an interrupted sweep stops its runs, they resume on restart
+        for name, process, log_file in running.values():
+            if process.poll() is None:
+                os.killpg(process.pid, signal.SIGTERM)
+                process.wait()
+            log_file.close()
+            state.update(name, status='interrupted')
+
+
+def summarize(state, names, columns, results_file):
+    '''
+    write the best perf of every run to results_file and log the mean and
+    std over the seeds of every combination
+    '''
+    rows = []
+    for name in names:
+        run = state.runs[name]
+        summary_file = run['cfg'].replace('.yaml', '_summary.txt')
+        if not os.path.exists(summary_file):
+            continue
+        with open(summary_file) as f:
+            lines = [line.strip() for line in f if line.strip()]
+        output_dir, perf = lines[-1].rsplit(',', 1)
+        rows.append(dict(run['values'], SEED=run['seed'], perf=float(perf),
+                         output_dir=output_dir))
+
+    with open(results_file, 'w') as f:
+        writer = csv.DictWriter(
+            f, fieldnames=columns + ['SEED', 'perf', 'output_dir'])
+        writer.writeheader()
+        writer.writerows(rows)
+
+    groups = {}
+    for row in rows:
+        combination = tuple(str(row[column]) for column in columns)
+        groups.setdefault(combination, []).append(row['perf'])
+
+    lines = [' | '.join(columns + ['runs', 'perf mean', 'perf std'])]
+    for combination, perfs in groups.items():
+        lines.append(' | '.join(list(combination) + [
+            str(len(perfs)),
+            '{:.4f}'.format(np.mean(perfs)),
+            '{:.4f}'.format(np.std(perfs))
+        ]))
+    logger.info('=> {} of {} runs finished, results in {}\n{}'.format(
+        len(rows), len(names), results_file, '\n'.join(lines)))
+
+
+def main():
+    args = parse_args()
+    update_config(cfg, args)
+
+    base_name = os.path.basename(args.cfg).split('.')[0]
+    sweep_dir = os.path.join(cfg.OUTPUT_DIR, 'sweeps', args.name or base_name)
+    config_dir = os.path.join(sweep_dir, 'configs')
+    log_dir = os.path.join(sweep_dir, 'logs')
+    for path in [config_dir, log_dir]:
+        os.makedirs(path, exist_ok=True)
+    # the annotations are shared by all sweeps on the same data
+    cache_dir = os.path.abspath(
+        cfg.DATASET.CACHE_DIR or os.path.join(cfg.OUTPUT_DIR, 'cache'))
+
+    logging.basicConfig(
+        format='%(asctime)-15s %(message)s', level=logging.INFO,
+        handlers=[logging.StreamHandler(),
+                  logging.FileHandler(os.path.join(sweep_dir, 'sweep.log'))])
+
+    grids = [parse_grid(grid) for grid in args.grid] or [[{}]]
+    columns = []
+    for grid in args.grid:
+        for item in grid:
+            key = item.partition('=')[0]
+            if key not in columns:
+                columns.append(key)
+
+    state = SweepState(os.path.join(sweep_dir, 'sweep_state.json'))
+    names = []
+    for overrides in itertools.chain(*grids):
+        for seed in args.seeds:
+            name = run_name(base_name, overrides, seed)
+            if name in names:
+                continue
+            run_file = os.path.abspath(
+                os.path.join(config_dir, name + '.yaml'))
+            write_run_config(args.cfg, overrides, seed, run_file)
+
+            # fail before launching anything if the config does not merge
+            run_cfg = cfg.clone()
+            run_cfg.defrost()
+            run_cfg.merge_from_file(run_file)
+            state.add(name, {
+                'cfg': run_file,
+                'seed': seed,
+                'values': {
+                    key: get_key(run_cfg, key) for key in columns
+                },
+            })
+            names.append(name)
+
+    slots = get_slots(args)
+    if args.dryRun:
+        for name in names:
+            logger.info('=> {} ({})'.format(name, state.runs[name]['status']))
+        logger.info('=> {} runs on {} slots'.format(len(names), len(slots)))
+        return
+
+    # stop the runs when the sweep itself is killed, e.g. by the scheduler
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    run_sweep(args, state, names, slots, log_dir, cache_dir)
+    summarize(state, names, columns, os.path.join(sweep_dir, 'results.csv'))
+
+
+if __name__ == '__main__':
+    main()
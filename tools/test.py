@@ -12,6 +12,7 @@ from __future__ import print_function
 import argparse
 import os
 import pprint
+import time
 
 import torch
 import torch.nn.parallel
@@ -24,8 +25,15 @@ import torchvision.transforms as transforms
 import _init_paths
 from config import cfg
 from config import update_config
-from core.loss import JointsMSELoss
+from core.loss import get_loss
 from core.function import validate
+from utils.amp import prepare_inference_model
+from utils.compile import compile_model
+from utils.distributed import broadcast_object
+from utils.distributed import get_device
+from utils.distributed import init_distributed
+from utils.distributed import ShardSampler
+from utils.export import load_exported_model
 from utils.utils import create_logger
 
 import dataset
@@ -69,9 +77,11 @@ def parse_args():
 def main():
     args = parse_args()
     update_config(cfg, args)
+    distributed = init_distributed(cfg)
 
+    time_str = broadcast_object(time.strftime('%y-%m-%d-%H-%M'))
     logger, final_output_dir, tb_log_dir = create_logger(
-        cfg, args.cfg, 'valid')
+        cfg, args.cfg, 'valid', time_str)
 
     logger.info(pprint.pformat(args))
     logger.info(cfg)
@@ -81,26 +91,42 @@ def main():
     torch.backends.cudnn.deterministic = cfg.CUDNN.DETERMINISTIC
     torch.backends.cudnn.enabled = cfg.CUDNN.ENABLED
 
-    model = eval('models.'+cfg.MODEL.NAME+'.get_pose_net')(
-        cfg, is_train=False
-    )
-
-    if cfg.TEST.MODEL_FILE:
-        logger.info('=> loading model from {}'.format(cfg.TEST.MODEL_FILE))
-        model.load_state_dict(torch.load(cfg.TEST.MODEL_FILE), strict=False)
+    device = get_device(cfg)
+    if cfg.TEST.EXPORTED_MODEL:
+        # single device, the exported graph replaces the python model
+        model = load_exported_model(cfg.TEST.EXPORTED_MODEL, device)
     else:
-        model_state_file = os.path.join(
-            final_output_dir, 'final_state.pth'
+        model = eval('models.'+cfg.MODEL.NAME+'.get_pose_net')(
+            cfg, is_train=False
         )
-        logger.info('=> loading model from {}'.format(model_state_file))
-        model.load_state_dict(torch.load(model_state_file))
 
-    model = torch.nn.DataParallel(model, device_ids=cfg.GPUS).cuda()
+        if cfg.TEST.MODEL_FILE:
+            logger.info(
+                '=> loading model from {}'.format(cfg.TEST.MODEL_FILE))
+            model.load_state_dict(
+                torch.load(cfg.TEST.MODEL_FILE, map_location=device),
+                strict=False)
+        else:
+            model_state_file = os.path.join(
+                final_output_dir, 'final_state.pth'
+            )
+            logger.info('=> loading model from {}'.format(model_state_file))
+            model.load_state_dict(
+                torch.load(model_state_file, map_location=device))
+
+        model.eval()
+        model = prepare_inference_model(cfg, model, device)
+        # without gradients there is nothing to synchronize, a
+        # distributed rank runs the plain model on its shard
+        if not distributed:
+            # without cuda DataParallel runs the model as it is, on the cpu
+            model = torch.nn.DataParallel(
+                model, device_ids=cfg.GPUS).to(device)
+        model = compile_model(cfg, model, torch.randn(
+            1, 3, cfg.MODEL.IMAGE_SIZE[1], cfg.MODEL.IMAGE_SIZE[0]))
 
     # define loss function (criterion) and optimizer
-    criterion = JointsMSELoss(
-        use_target_weight=cfg.LOSS.USE_TARGET_WEIGHT
-    ).cuda()
+    criterion = get_loss(cfg).to(device)
 
     # Data loading code
     normalize = transforms.Normalize(
@@ -115,8 +141,10 @@ def main():
     )
     valid_loader = torch.utils.data.DataLoader(
         valid_dataset,
-        batch_size=cfg.TEST.BATCH_SIZE_PER_GPU*len(cfg.GPUS),
+        batch_size=cfg.TEST.BATCH_SIZE_PER_GPU*(
+            1 if distributed else len(cfg.GPUS)),
         shuffle=False,
+        sampler=ShardSampler(valid_dataset) if distributed else None,
         num_workers=cfg.WORKERS,
         pin_memory=True
     )
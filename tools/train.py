@@ -9,9 +9,13 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import logging
+import math
 import os
 import pprint
+import random
 import shutil
+import time
 
 import torch
 import torch.nn.parallel
@@ -25,11 +29,28 @@ from tensorboardX import SummaryWriter
 import _init_paths
 from config import cfg
 from config import update_config
-from core.loss import JointsMSELoss
+from core.async_eval import AsyncEvaluator
+from core.distill import Teacher
+from core.loss import get_loss
 from core.function import train
 from core.function import validate
+from core.function import log_evaluation
+from utils.amp import get_grad_scaler
+from utils.checkpoint import Checkpointer
+from utils.checkpoint import get_rng_state
+from utils.checkpoint import set_rng_state
+from utils.checkpoint import set_seed
+from utils.compile import compile_model
+from utils.distributed import broadcast_object
+from utils.distributed import get_device
+from utils.distributed import get_world_size
+from utils.distributed import init_distributed
+from utils.distributed import is_main_process
+from utils.distributed import ResumableSampler
+from utils.distributed import ShardSampler
+from utils.utils import atomic_save
 from utils.utils import get_optimizer
-from utils.utils import save_checkpoint
+from utils.utils import get_resume_time_str
 from utils.utils import create_logger
 from utils.utils import get_model_summary
 
@@ -73,12 +94,97 @@ def parse_args():
     return args
 
 
+def submit_evaluation(cfg, valid_loader, valid_dataset, model, criterion,
+                      output_dir, tb_log_dir, writer_dict, evaluator, epoch):
+    # only the inference runs here, the best model is saved when its
+    # evaluation comes back
+    eval_tag = {
+        'epoch': epoch,
+        'global_steps': writer_dict['valid_global_steps'],
+        'state_dict': {
+            k: v.detach().cpu().clone()
+            for k, v in model.module.state_dict().items()
+        },
+    }
+    validate(
+        cfg, valid_loader, valid_dataset, model, criterion,
+        output_dir, tb_log_dir, writer_dict,
+        evaluator=evaluator, eval_tag=eval_tag
+    )
+
+
+def collect_async_evaluation(cfg, evaluator, writer_dict, checkpointer,
+                             output_dir, wait=False):
+    '''
+    logs the finished evaluations and saves the best model, the perf is
+    kept in checkpointer
+    '''
+    logger = logging.getLogger(__name__)
+    for tag, name_values, perf_indicator in evaluator.collect(wait):
+        logger.info('=> evaluation of epoch {} done'.format(tag['epoch']))
+        log_evaluation(cfg, name_values, writer_dict, tag['global_steps'])
+
+        checkpointer.perf = perf_indicator
+        if perf_indicator >= checkpointer.best_perf:
+            checkpointer.best_perf = perf_indicator
+            best_model_file = os.path.join(output_dir, 'model_best.pth')
+            logger.info('=> saving best model to {}'.format(best_model_file))
+            atomic_save(tag['state_dict'], best_model_file)
+
+    if wait:
+        checkpointer.pending_eval = None
+
+
+def evaluate_pending(cfg, valid_loader, valid_dataset, model, criterion,
+                     output_dir, tb_log_dir, writer_dict, evaluator,
+                     checkpointer):
+    '''
+    evaluates again the epoch whose background evaluation was lost with
+    the interrupted run, its checkpoint holds the model of that epoch
+    '''
+    logger = logging.getLogger(__name__)
+    epoch = checkpointer.pending_eval
+    logger.info('=> evaluating epoch {} again'.format(epoch))
+
+    # the interrupted run validated before its checkpoint, at these steps
+    # and with the rng state before the validation
+    rng_state = get_rng_state()
+    if writer_dict:
+        writer_dict['valid_global_steps'] -= 1
+
+    if evaluator is not None:
+        submit_evaluation(cfg, valid_loader, valid_dataset, model, criterion,
+                          output_dir, tb_log_dir, writer_dict, evaluator,
+                          epoch)
+    else:
+        perf_indicator = validate(
+            cfg, valid_loader, valid_dataset, model, criterion,
+            output_dir, tb_log_dir, writer_dict
+        )
+        checkpointer.perf = perf_indicator
+        if perf_indicator >= checkpointer.best_perf:
+            checkpointer.best_perf = perf_indicator
+            if is_main_process():
+                atomic_save(model.module.state_dict(),
+                            os.path.join(output_dir, 'model_best.pth'))
+        checkpointer.pending_eval = None
+
+    set_rng_state(rng_state)
+
+
 def main():
     args = parse_args()
     update_config(cfg, args)
-
+    distributed = init_distributed(cfg)
+
+    # every rank writes to the output directory of rank 0, a resumed run
+    # to the latest one with a checkpoint
+    time_str = None
+    if cfg.AUTO_RESUME:
+        time_str = get_resume_time_str(cfg, args.cfg)
+    time_str = broadcast_object(time_str or time.strftime('%y-%m-%d-%H-%M'))
     logger, final_output_dir, tb_log_dir = create_logger(
-        cfg, args.cfg, 'train')
+        cfg, args.cfg, 'train', time_str)
 
     logger.info(pprint.pformat(args))
     logger.info(cfg)
@@ -88,36 +194,55 @@ def main():
     torch.backends.cudnn.deterministic = cfg.CUDNN.DETERMINISTIC
     torch.backends.cudnn.enabled = cfg.CUDNN.ENABLED
 
+    if cfg.SEED >= 0:
+        set_seed(cfg.SEED)
+    # a resumed run continues with the seed of its checkpoint
+    seed = cfg.SEED if cfg.SEED >= 0 \
+        else broadcast_object(random.randrange(2 ** 31))
+
     model = eval('models.'+cfg.MODEL.NAME+'.get_pose_net')(
         cfg, is_train=True
     )
 
-    # copy model file
-    this_dir = os.path.dirname(__file__)
-    shutil.copy2(
-        os.path.join(this_dir, '../lib/models', cfg.MODEL.NAME + '.py'),
-        final_output_dir)
-    # logger.info(pprint.pformat(model))
-
-    writer_dict = {
-        'writer': SummaryWriter(log_dir=tb_log_dir),
-        'train_global_steps': 0,
-        'valid_global_steps': 0,
-    }
-
     dump_input = torch.rand(
         (1, 3, cfg.MODEL.IMAGE_SIZE[1], cfg.MODEL.IMAGE_SIZE[0])
     )
-    writer_dict['writer'].add_graph(model, (dump_input, ))
-
-    logger.info(get_model_summary(model, dump_input))
 
-    model = torch.nn.DataParallel(model, device_ids=cfg.GPUS).cuda()
+    # only rank 0 writes tensorboard summaries and checkpoints
+    writer_dict = None
+    if is_main_process():
+        # copy model file
+        this_dir = os.path.dirname(__file__)
+        shutil.copy2(
+            os.path.join(this_dir, '../lib/models', cfg.MODEL.NAME + '.py'),
+            final_output_dir)
+        # logger.info(pprint.pformat(model))
+
+        writer_dict = {
+            'writer': SummaryWriter(log_dir=tb_log_dir),
+            'train_global_steps': 0,
+            'valid_global_steps': 0,
+        }
+        writer_dict['writer'].add_graph(model, (dump_input, ))
+
+        logger.info(get_model_summary(model, dump_input))
+
+    device = get_device(cfg)
+    if distributed:
+        # one process per device, gradients are all-reduced in backward
+        model = torch.nn.parallel.DistributedDataParallel(
+            model.to(device),
+            device_ids=[device.index] if device.type == 'cuda' else None
+        )
+        batch_gpus = 1
+    else:
+        # without cuda DataParallel runs the model as it is, on the cpu
+        model = torch.nn.DataParallel(model, device_ids=cfg.GPUS).to(device)
+        batch_gpus = len(cfg.GPUS)
+    model = compile_model(cfg, model, dump_input)
 
     # define loss function (criterion) and optimizer
-    criterion = JointsMSELoss(
-        use_target_weight=cfg.LOSS.USE_TARGET_WEIGHT
-    ).cuda()
+    criterion = get_loss(cfg).to(device)
 
     # Data loading code
     normalize = transforms.Normalize(
@@ -138,76 +263,173 @@ def main():
         ])
     )
 
+    # the sample order only depends on the seed and the epoch, so a
+    # resumed epoch can skip what was already trained on
+    train_sampler = ResumableSampler(
+        train_dataset, shuffle=cfg.TRAIN.SHUFFLE, seed=seed
+    )
+    valid_sampler = None
+    if distributed:
+        valid_sampler = ShardSampler(valid_dataset)
+
     train_loader = torch.utils.data.DataLoader(
         train_dataset,
-        batch_size=cfg.TRAIN.BATCH_SIZE_PER_GPU*len(cfg.GPUS),
-        shuffle=cfg.TRAIN.SHUFFLE,
+        batch_size=cfg.TRAIN.BATCH_SIZE_PER_GPU*batch_gpus,
+        shuffle=False,
+        sampler=train_sampler,
         num_workers=cfg.WORKERS,
         pin_memory=cfg.PIN_MEMORY
     )
     valid_loader = torch.utils.data.DataLoader(
         valid_dataset,
-        batch_size=cfg.TEST.BATCH_SIZE_PER_GPU*len(cfg.GPUS),
+        batch_size=cfg.TEST.BATCH_SIZE_PER_GPU*batch_gpus,
         shuffle=False,
+        sampler=valid_sampler,
         num_workers=cfg.WORKERS,
         pin_memory=cfg.PIN_MEMORY
     )
 
+    # gradients of ACCUM_STEPS batches make one optimizer step
+    batch_size = cfg.TRAIN.BATCH_SIZE_PER_GPU * batch_gpus \
+        * get_world_size() * cfg.TRAIN.ACCUM_STEPS
+    lr = cfg.TRAIN.LR
+    if cfg.TRAIN.BASE_BATCH_SIZE > 0:
+        # linear scaling rule
+        lr = cfg.TRAIN.LR * batch_size / cfg.TRAIN.BASE_BATCH_SIZE
+    steps_per_epoch = int(
+        math.ceil(len(train_loader) / float(cfg.TRAIN.ACCUM_STEPS)))
+    logger.info('=> batch size {} ({} accumulation steps), lr {:g}, '
+                '{} optimizer steps per epoch'.format(
+                    batch_size, cfg.TRAIN.ACCUM_STEPS, lr, steps_per_epoch))
+
     best_perf = 0.0
     best_model = False
-    last_epoch = -1
-    optimizer = get_optimizer(cfg, model)
+    last_step = -1
+    scheduler_state = None
+    checkpoint = None
+    optimizer = get_optimizer(cfg, model, lr)
+    scaler = get_grad_scaler(cfg, device)
     begin_epoch = cfg.TRAIN.BEGIN_EPOCH
+    start_iter = 0
     checkpoint_file = os.path.join(
         final_output_dir, 'checkpoint.pth'
     )
 
     if cfg.AUTO_RESUME and os.path.exists(checkpoint_file):
         logger.info("=> loading checkpoint '{}'".format(checkpoint_file))
-        checkpoint = torch.load(checkpoint_file)
-        begin_epoch = checkpoint['epoch']
-        best_perf = checkpoint['perf']
-        last_epoch = checkpoint['epoch']
+        checkpoint = torch.load(checkpoint_file, map_location=device)
+        scheduler_state = checkpoint.get('lr_scheduler')
+        if scheduler_state is None:
+            # checkpoint of an epoch stepped scheduler
+            last_step = checkpoint['epoch'] * steps_per_epoch - 1
         model.load_state_dict(checkpoint['state_dict'])
 
         optimizer.load_state_dict(checkpoint['optimizer'])
-        logger.info("=> loaded checkpoint '{}' (epoch {})".format(
-            checkpoint_file, checkpoint['epoch']))
+        if scaler is not None and 'scaler' in checkpoint:
+            scaler.load_state_dict(checkpoint['scaler'])
+        logger.info("=> loaded checkpoint '{}' (epoch {}, iteration {})"
+                    .format(checkpoint_file, checkpoint['epoch'],
+                            checkpoint.get('iteration', 0)))
 
+    # stepped after every optimizer step, LR_STEP is in epochs
     lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(
-        optimizer, cfg.TRAIN.LR_STEP, cfg.TRAIN.LR_FACTOR,
-        last_epoch=last_epoch
+        optimizer, [epoch * steps_per_epoch for epoch in cfg.TRAIN.LR_STEP],
+        cfg.TRAIN.LR_FACTOR, last_epoch=last_step
+    )
+    if scheduler_state is not None:
+        lr_scheduler.load_state_dict(scheduler_state)
+
+    checkpointer = Checkpointer(
+        cfg, final_output_dir, model, optimizer, lr_scheduler, scaler,
+        train_sampler, writer_dict
     )
 
+    evaluator = None
+    if cfg.TEST.ASYNC_EVAL and distributed:
+        logger.warning('=> TEST.ASYNC_EVAL is ignored in distributed runs')
+    elif cfg.TEST.ASYNC_EVAL:
+        evaluator = AsyncEvaluator(cfg, valid_dataset, final_output_dir)
+        # a checkpoint within an epoch can not evaluate the last one again
+        checkpointer.before_save = lambda: collect_async_evaluation(
+            cfg, evaluator, writer_dict, checkpointer, final_output_dir,
+            wait=True
+        )
+
+    teacher = None
+    if cfg.DISTILL.ENABLED:
+        teacher = Teacher(cfg, len(train_dataset))
+
+    # the rng states last, right before the training continues
+    if checkpoint is not None:
+        begin_epoch, start_iter = checkpointer.load(checkpoint)
+        if checkpointer.pending_eval is not None:
+            evaluate_pending(
+                cfg, valid_loader, valid_dataset, model, criterion,
+                final_output_dir, tb_log_dir, writer_dict, evaluator,
+                checkpointer
+            )
+        best_perf = checkpointer.best_perf
+        del checkpoint
+
     for epoch in range(begin_epoch, cfg.TRAIN.END_EPOCH):
-        lr_scheduler.step()
+        train_sampler.set_epoch(epoch)
+        train_dataset.set_epoch(epoch, train_sampler.seed)
+        if epoch != begin_epoch:
+            start_iter = 0
+        train_sampler.set_start(start_iter * train_loader.batch_size)
 
         # train for one epoch
         train(cfg, train_loader, model, criterion, optimizer, epoch,
-              final_output_dir, tb_log_dir, writer_dict)
+              final_output_dir, tb_log_dir, writer_dict, teacher=teacher,
+              scaler=scaler, lr_scheduler=lr_scheduler,
+              checkpointer=checkpointer, start_iter=start_iter)
+        if teacher is not None:
+            teacher.flush()
 
 
         # evaluate on validation set
-        perf_indicator = validate(
-            cfg, valid_loader, valid_dataset, model, criterion,
-            final_output_dir, tb_log_dir, writer_dict
-        )
-
-        if perf_indicator >= best_perf:
-            best_perf = perf_indicator
-            best_model = True
-        else:
+        if evaluator is not None:
+            # the evaluation of the last epoch had this one to finish, only
+            # the evaluation of this epoch is pending in the checkpoint
+            collect_async_evaluation(
+                cfg, evaluator, writer_dict, checkpointer, final_output_dir,
+                wait=True
+            )
+            submit_evaluation(
+                cfg, valid_loader, valid_dataset, model, criterion,
+                final_output_dir, tb_log_dir, writer_dict, evaluator, epoch
+            )
+            checkpointer.pending_eval = epoch
             best_model = False
+        else:
+            perf_indicator = validate(
+                cfg, valid_loader, valid_dataset, model, criterion,
+                final_output_dir, tb_log_dir, writer_dict
+            )
+
+            if perf_indicator >= best_perf:
+                best_perf = perf_indicator
+                best_model = True
+            else:
+                best_model = False
+
+            checkpointer.perf = perf_indicator
+            checkpointer.best_perf = best_perf
+
+        checkpointer.save(epoch + 1, is_best=best_model)
+
+    checkpointer.close()
+
+    if evaluator is not None:
+        collect_async_evaluation(
+            cfg, evaluator, writer_dict, checkpointer, final_output_dir,
+            wait=True
+        )
+        evaluator.close()
+    best_perf = checkpointer.best_perf
 
-        logger.info('=> saving checkpoint to {}'.format(final_output_dir))
-        save_checkpoint({
-            'epoch': epoch + 1,
-            'model': cfg.MODEL.NAME,
-            'state_dict': model.state_dict(),
-            'best_state_dict': model.module.state_dict(),
-            'perf': perf_indicator,
-            'optimizer': optimizer.state_dict(),
-        }, best_model, final_output_dir)
+    if not is_main_process():
+        return
 
     final_model_state_file = os.path.join(
         final_output_dir, 'final_state.pth'
@@ -215,7 +437,7 @@ def main():
     logger.info('=> saving final model state to {}'.format(
         final_model_state_file)
     )
-    torch.save(model.module.state_dict(), final_model_state_file)
+    atomic_save(model.module.state_dict(), final_model_state_file)
     writer_dict['writer'].close()
 
     # write summary text